@@ -0,0 +1,253 @@
+"""Benchmark riproducibile di Game Folder Cleaner.
+
+Genera alberi sintetici di giochi RenPy e RPGM (anche con livello annidato, per esercitare il flatten),
+misura tempo, chiamate di sistema e picco di memoria delle funzioni principali e scrive un report JSON
+confrontabile tra esecuzioni. Opzionalmente aggiunge una latenza artificiale a ogni chiamata per simulare NFS.
+
+Esempio:
+    python benchmark.py --games 4 --files 2000 --latency-ms 0.2 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import multiprocessing
+
+import game_folder_cleaner as gfc
+
+# Layout dei motori supportati dal generatore: cartella degli asset e cartella dei salvataggi
+ENGINE_LAYOUTS = {
+    'renpy': {'assets': ('game',), 'saves': ('game', 'saves'), 'save_ext': '.save', 'extra': ('lib', 'renpy')},
+    'rpgm': {'assets': ('www',), 'saves': ('www', 'save'), 'save_ext': '.rpgsave', 'extra': ('locales',)},
+}
+
+# Funzioni di os contate (e rallentate con --latency-ms); DirEntry.stat viene contata tramite il proxy di scandir
+COUNTED_CALLS = ['stat', 'lstat', 'listdir', 'open', 'unlink', 'remove', 'rmdir', 'chown', 'chmod', 'rename']
+
+
+def generate_game_tree(path, engine='renpy', files=1000, depth=3, fanout=4, file_size=1024, saves=5, nested=False, seed=0):
+    """Crea un gioco sintetico in path: files file di asset distribuiti su depth livelli (fanout cartelle per livello),
+    saves salvataggi e, con nested=True, un livello di cartella aggiuntivo (/NOME/NOME-v1.0/...).
+    """
+    layout = ENGINE_LAYOUTS[engine]
+    rng = random.Random(seed)
+    root = os.path.join(path, f'{os.path.basename(path)}-v1.0') if nested else path
+    payload = b'\0' * file_size
+    asset_dirs = []
+    for top in layout['assets'] + layout['extra']:
+        base = os.path.join(root, top)
+        level = [base]
+        for _ in range(depth):
+            level = [os.path.join(d, f'd{i}') for d in level for i in range(fanout)]
+            asset_dirs.extend(level)
+        asset_dirs.append(base)
+    for i in range(files):
+        directory = rng.choice(asset_dirs)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'asset{i}.bin'), 'wb') as f:
+            f.write(payload)
+    save_dir = os.path.join(root, *layout['saves'])
+    os.makedirs(save_dir, exist_ok=True)
+    for i in range(saves):
+        with open(os.path.join(save_dir, f'{i + 1}-1{layout["save_ext"]}'), 'wb') as f:
+            f.write(payload)
+    with open(os.path.join(root, 'Game.exe'), 'wb') as f:
+        f.write(payload)
+    return path
+
+
+def generate_library(root, games, **kwargs):
+    """Crea games giochi in root, alternando RenPy/RPGM e layout piatti/annidati."""
+    os.makedirs(root, exist_ok=True)
+    for i in range(games):
+        engine = 'renpy' if i % 2 == 0 else 'rpgm'
+        generate_game_tree(os.path.join(root, f'Game{i:03d}'), engine=engine, nested=(i % 4 >= 2), seed=i, **kwargs)
+    return root
+
+
+class _CountingScandir:
+    """Proxy di os.scandir che conta (e rallenta) le DirEntry.stat, non intercettabili altrimenti."""
+
+    def __init__(self, it, counter):
+        self._it = it
+        self._counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._it.close()
+
+    def __iter__(self):
+        for entry in self._it:
+            yield _CountingDirEntry(entry, self._counter)
+
+    def close(self):
+        self._it.close()
+
+
+class _CountingDirEntry:
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def __fspath__(self):
+        return self._entry.path
+
+    def stat(self, *args, **kwargs):
+        self._counter('direntry_stat')
+        return self._entry.stat(*args, **kwargs)
+
+
+def instrument_syscalls(latency_ms=0.0):
+    """Sostituisce le funzioni di os con versioni che contano le chiamate e aggiungono latency_ms.
+    Ritorna il dict dei conteggi (aggiornato in place).
+    """
+    counts = {}
+    delay = latency_ms / 1000.0
+
+    def count(name):
+        counts[name] = counts.get(name, 0) + 1
+        if delay:
+            time.sleep(delay)
+
+    def wrap(name, func):
+        def wrapper(*args, **kwargs):
+            count(name)
+            return func(*args, **kwargs)
+        return wrapper
+
+    for name in COUNTED_CALLS:
+        setattr(os, name, wrap(name, getattr(os, name)))
+    real_scandir = os.scandir
+
+    def scandir(*args, **kwargs):
+        count('scandir')
+        return _CountingScandir(real_scandir(*args, **kwargs), count)
+
+    os.scandir = scandir
+    return counts
+
+
+def _case_get_folder_size(root, args):
+    return lambda: gfc.get_folder_size(os.path.join(root, 'Game000'))
+
+
+def _case_wait_for_stable_folder(root, args):
+    return lambda: gfc.wait_for_stable_folder(os.path.join(root, 'Game000'), stable_seconds=args.stable_seconds,
+                                              check_interval=args.stable_seconds / 4)
+
+
+def _case_set_permissions(root, args):
+    return lambda: gfc.set_permissions(os.path.join(root, 'Game000'))
+
+
+def _case_clean_game_folder(root, args):
+    return lambda: gfc.clean_game_folder(os.path.join(root, 'Game000'))
+
+
+def _case_scan_and_process_folders(root, args):
+    gfc.STABLE_SECONDS = args.stable_seconds
+    gfc.STABLE_CHECK_INTERVAL = args.stable_seconds / 4
+    return gfc.scan_and_process_folders
+
+
+BENCHMARK_CASES = {
+    'get_folder_size': _case_get_folder_size,
+    'wait_for_stable_folder': _case_wait_for_stable_folder,
+    'set_permissions': _case_set_permissions,
+    'clean_game_folder': _case_clean_game_folder,
+    'scan_and_process_folders': _case_scan_and_process_folders,
+}
+
+
+def _run_case(name, args, conn):
+    """Eseguito in un processo figlio: genera l'albero, prepara il caso e misura solo la chiamata."""
+    workdir = tempfile.mkdtemp(prefix=f'gfc-bench-{name}-', dir=args.workdir)
+    try:
+        root = generate_library(os.path.join(workdir, 'library'), args.games, files=args.files, depth=args.depth,
+                                fanout=args.fanout, file_size=args.file_size, saves=args.saves)
+        gfc.FOLDER_WATCHED = root
+        gfc.TELEGRAM_ENABLED = False  # Telegram disattivato: nessuna chiamata di rete durante le misure
+        call = BENCHMARK_CASES[name](root, args)
+        counts = instrument_syscalls(args.latency_ms)
+        start = time.perf_counter()
+        call()
+        wall = time.perf_counter() - start
+        conn.send({
+            'case': name,
+            'wall_seconds': round(wall, 6),
+            'syscalls': dict(sorted(counts.items())),
+            'syscalls_total': sum(counts.values()),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        conn.close()
+
+
+def run_benchmarks(args):
+    """Esegue ogni caso args.repeat volte, ciascuno in un processo separato (picco RSS isolato)."""
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    for name in args.cases:
+        for _ in range(args.repeat):
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_run_case, args=(name, args, child_conn))
+            proc.start()
+            child_conn.close()
+            try:
+                results.append(parent_conn.recv())
+            except EOFError:
+                results.append({'case': name, 'error': f'processo terminato con codice {proc.exitcode}'})
+            proc.join()
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'app_version': gfc.APP_VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {k: v for k, v in vars(args).items() if k not in ('output',)},
+        },
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description='Benchmark di Game Folder Cleaner (output JSON)')
+    p.add_argument('--games', type=int, default=4, help='Numero di giochi sintetici (RenPy/RPGM, piatti e annidati)')
+    p.add_argument('--files', type=int, default=1000, help='File di asset per gioco')
+    p.add_argument('--depth', type=int, default=3, help='Profondità delle cartelle di asset')
+    p.add_argument('--fanout', type=int, default=4, help='Sottocartelle per livello')
+    p.add_argument('--file-size', type=int, default=1024, help='Dimensione di ogni file in byte')
+    p.add_argument('--saves', type=int, default=5, help='Salvataggi per gioco')
+    p.add_argument('--stable-seconds', type=float, default=0.5, help='Finestra di stabilità usata nei casi che la richiedono')
+    p.add_argument('--latency-ms', type=float, default=0.0, help='Latenza artificiale per chiamata di sistema (simula NFS)')
+    p.add_argument('--repeat', type=int, default=1, help='Ripetizioni per caso')
+    p.add_argument('--cases', nargs='+', choices=list(BENCHMARK_CASES), default=list(BENCHMARK_CASES), help='Casi da eseguire')
+    p.add_argument('--workdir', default=None, help='Cartella in cui generare gli alberi (default: temp di sistema)')
+    p.add_argument('--output', default='-', help='File JSON di output (default stdout)')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output == '-':
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,66 @@
 import os
+import stat
 import shutil
 import time
 import logging
 import requests
 import csv
 import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 import base64
 import binascii
 import re
+import sqlite3
+import threading
+import ctypes
+import ctypes.util
+import select
+import struct
+import errno
+import queue
+import atexit
+import signal
+import fnmatch
+import json
+import sys
+import platform
+import zlib
+import heapq
+import hashlib
+import fcntl
+import filecmp
 
 # Carica .env se presente
 load_dotenv()
 
-# Stato globale per tracciare l'ultima notifica Telegram inviata
+# Stato globale per tracciare l'ultima notifica Telegram inviata (protetto da _telegram_lock)
 last_telegram_notification = 0
 TELEGRAM_NOTIFICATION_INTERVAL = 300  # 5 minuti
+_telegram_lock = threading.Lock()
+
+# Dispatcher Telegram asincrono: endpoint (sovrascrivibile per test con uno stub locale),
+# coda limitata, finestra di accorpamento messaggi e attesa massima di svuotamento all'uscita
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_QUEUE_SIZE = int(os.getenv('TELEGRAM_QUEUE_SIZE', '100'))
+TELEGRAM_COALESCE_SECONDS = float(os.getenv('TELEGRAM_COALESCE_SECONDS', '2'))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '5'))
+TELEGRAM_DRAIN_TIMEOUT = float(os.getenv('TELEGRAM_DRAIN_TIMEOUT', '30'))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 
 # Defaults pensati per esecuzione in container/k3s
 DEFAULT_FOLDER_WATCHED = '/data'
+# Una o più cartelle radice separate da os.pathsep (':' su Linux, come PATH), ciascuna con il proprio ledger;
+# da riga di comando (--folder ripetuto) diventa direttamente una lista
 FOLDER_WATCHED = os.getenv('FOLDER_WATCHED', DEFAULT_FOLDER_WATCHED)
+# Radici scansionate contemporaneamente (0 = tutte)
+ROOT_WORKERS = int(os.getenv('ROOT_WORKERS', '0'))
+# Sharding deterministico tra più pod (--shard i/N): ogni pod lavora solo le cartelle il cui hash del nome vale i modulo N
+SHARD = os.getenv('SHARD', '')
 
 # Versione dell'app (configurabile via env APP_VERSION)
 APP_VERSION = os.getenv('APP_VERSION', '1.0.1')
@@ -30,6 +70,125 @@ _raw_telegram_bot = os.getenv('TELEGRAM_BOT_TOKEN')
 _raw_telegram_chat = os.getenv('TELEGRAM_CHAT_ID')
 CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', '86400'))  # default 24h
 
+# Pipeline parallela: WORKERS > 1 abilita la modalità a pool (sovrascrivibile con --workers)
+WORKERS = int(os.getenv('WORKERS', '1'))
+# Numero massimo di cartelle osservate contemporaneamente in attesa di stabilità
+STABILITY_WATCHERS = int(os.getenv('STABILITY_WATCHERS', '32'))
+
+# Attesa stabilità: secondi senza modifiche, intervallo di controllo e attesa massima (0 = nessun limite)
+STABLE_SECONDS = float(os.getenv('STABLE_SECONDS', '20'))
+STABLE_CHECK_INTERVAL = float(os.getenv('STABLE_CHECK_INTERVAL', '2'))
+STABLE_MAX_WAIT = float(os.getenv('STABLE_MAX_WAIT', '21600'))  # default 6h
+
+# Cartelle fallite (permessi o non stabili) e non più modificate: nuovo tentativo dopo un backoff esponenziale
+RETRY_BACKOFF_BASE = float(os.getenv('RETRY_BACKOFF_BASE', '3600'))  # default 1h
+RETRY_BACKOFF_MAX = float(os.getenv('RETRY_BACKOFF_MAX', '604800'))  # default 7 giorni
+
+# Ordine della coda di un ciclo: 'name' (alfabetico), 'largest' (più spazio recuperabile prima), 'oldest' (mtime più vecchio prima)
+SCHEDULE_POLICIES = ('name', 'largest', 'oldest')
+SCHEDULE_POLICY = os.getenv('SCHEDULE_POLICY', 'name').lower()
+# Il ciclo parte solo se il volume è occupato almeno a questa percentuale (0 = sempre)
+SCHEDULE_DISK_THRESHOLD = float(os.getenv('SCHEDULE_DISK_THRESHOLD', '0'))
+# Budget per ciclo: secondi e byte liberati dopo i quali non si iniziano altre cartelle (0 = nessun limite)
+CYCLE_TIME_BUDGET = float(os.getenv('CYCLE_TIME_BUDGET', '0'))
+CYCLE_BYTES_BUDGET = int(os.getenv('CYCLE_BYTES_BUDGET', '0'))
+
+# Permessi: thread del motore permessi e ambito ('all' = tutto l'albero, 'survivors' = solo salvataggi e loro cartelle padre)
+PERMISSION_WORKERS = int(os.getenv('PERMISSION_WORKERS', '8'))
+PERMISSIONS_SCOPE = os.getenv('PERMISSIONS_SCOPE', 'all').lower()
+
+# Thread usati per le eliminazioni (su NFS domina la latenza di ogni unlink)
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', '8'))
+
+# Governor I/O per non saturare il server NFS condiviso: operazioni sui metadati (stat, scandir, chown, chmod)
+# e rimozioni (unlink, rmdir) al secondo, 0 = nessun limite. Con IO_LATENCY_TARGET_MS i limiti si abbassano
+# quando la latenza osservata supera l'obiettivo e risalgono gradualmente quando torna sotto.
+IO_METADATA_RATE = float(os.getenv('IO_METADATA_RATE', '0'))
+IO_UNLINK_RATE = float(os.getenv('IO_UNLINK_RATE', '0'))
+IO_LATENCY_TARGET_MS = float(os.getenv('IO_LATENCY_TARGET_MS', '0'))
+# Priorità I/O del processo via ioprio_set: 'idle' oppure 'best-effort:N' (N da 0 a 7), vuoto = invariata
+IO_PRIORITY = os.getenv('IO_PRIORITY', '').lower()
+
+# Modalità --watch: attesa dopo l'ultimo evento prima di lavorare una cartella e rescan completo di sicurezza (NFS)
+WATCH_DEBOUNCE = int(os.getenv('WATCH_DEBOUNCE', '30'))
+WATCH_RESCAN_INTERVAL = int(os.getenv('WATCH_RESCAN_INTERVAL', '0'))  # 0 = usa CHECK_INTERVAL
+
+# Metriche Prometheus: endpoint HTTP /metrics (Deployment), file per il textfile collector
+# o Pushgateway (CronJob). Disattivate se nessuna delle tre destinazioni è configurata.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE')
+METRICS_PUSHGATEWAY = os.getenv('METRICS_PUSHGATEWAY')
+METRICS_ENABLED = bool(METRICS_PORT or METRICS_TEXTFILE or METRICS_PUSHGATEWAY)
+
+# Stato persistente: ledger SQLite indicizzato nella cartella monitorata, CSV solo come export opzionale
+LEDGER_FILENAME = 'folders_state.db'
+CSV_LOG_FILENAME = 'folders_log.csv'
+CSV_EXPORT_ENABLED = os.getenv('CSV_EXPORT', 'true').lower() == 'true'
+# Rotazione dell'export CSV (dimensione in byte / età in giorni, 0 = disattivata) e segmenti archiviati da tenere
+CSV_ROTATE_BYTES = int(os.getenv('CSV_ROTATE_BYTES', str(10 * 1024 * 1024)))
+CSV_ROTATE_DAYS = int(os.getenv('CSV_ROTATE_DAYS', '30'))
+CSV_ROTATE_KEEP = int(os.getenv('CSV_ROTATE_KEEP', '5'))
+# Compattazione del ledger quando le righe superano LOG_COMPACT_RATIO volte il numero di cartelle
+LOG_COMPACT_RATIO = float(os.getenv('LOG_COMPACT_RATIO', '2'))
+
+# Deduplicazione dei salvataggi tra versioni dello stesso gioco dopo la pulizia: 'off', 'hardlink' o 'reflink'
+DEDUP_SAVES = os.getenv('DEDUP_SAVES', 'off').lower()
+
+
+def watched_roots():
+    """Cartelle radice configurate in FOLDER_WATCHED, normalizzate e senza duplicati."""
+    if isinstance(FOLDER_WATCHED, str):
+        parts = [part.strip() for part in FOLDER_WATCHED.split(os.pathsep)]
+    else:
+        parts = FOLDER_WATCHED
+    roots = []
+    for part in parts:
+        if part and os.path.normpath(part) not in roots:
+            roots.append(os.path.normpath(part))
+    return roots or [DEFAULT_FOLDER_WATCHED]
+
+
+def folder_root(folder):
+    """Radice (e quindi ledger) a cui appartiene una cartella di primo livello."""
+    return os.path.dirname(folder)
+
+
+def parse_shard(value):
+    """Converte 'i/N' in (i, N); stringa vuota = nessuno sharding (0, 1)."""
+    if not value:
+        return 0, 1
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'shard non valido: {value} (atteso i/N con 0 <= i < N)')
+    return index, count
+
+
+def in_shard(folder, shard=None):
+    """True se folder appartiene allo shard (i, N): crc32 del nome modulo N, stabile tra processi e pod."""
+    index, count = shard or SHARD_SPEC
+    return count == 1 or zlib.crc32(os.path.basename(folder).encode()) % count == index
+
+
+SHARD_SPEC = parse_shard(SHARD)
+
+
+def csv_log_filename():
+    """Nome dell'export CSV: con lo sharding ogni pod scrive il proprio file (folders_log.shard<i>of<N>.csv),
+    perché più writer bufferizzati sullo stesso CSV condiviso intreccerebbero righe parziali.
+    """
+    index, count = SHARD_SPEC
+    if count == 1:
+        return CSV_LOG_FILENAME
+    base, ext = os.path.splitext(CSV_LOG_FILENAME)
+    return f'{base}.shard{index}of{count}{ext}'
+
+
+def _csv_segment_key():
+    # Inizio del segmento CSV corrente nel meta del ledger, separato per ogni file di export
+    index, count = SHARD_SPEC
+    return 'csv_segment_started' if count == 1 else f'csv_segment_started.shard{index}of{count}'
+
 
 def _looks_like_base64(s: str) -> bool:
     """Rileva se una stringa *probabilmente* è in Base64.
@@ -74,439 +233,2794 @@ TELEGRAM_ENABLED = bool(TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID)
 # Logging base; può essere sovrascritto da argparser (debug)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Buffer per-thread: se attivo, le notifiche vengono accumulate invece che inviate subito
+_notification_buffer = threading.local()
+
+
+_telegram_queue = queue.Queue(maxsize=TELEGRAM_QUEUE_SIZE)
+_telegram_thread = None
+_telegram_session = None
+
+
+def _post_telegram(text):
+    """Invia un messaggio con la sessione HTTP condivisa, gestendo 429 (retry_after) e backoff esponenziale."""
+    global _telegram_session
+    if _telegram_session is None:
+        _telegram_session = requests.Session()
+    url = f'{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage'
+    data = {'chat_id': TELEGRAM_CHAT_ID, 'text': text}
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        delay = min(2 ** attempt, 60)
+        try:
+            resp = _telegram_session.post(url, data=data, timeout=10)
+            if resp.status_code == 200:
+                return True
+            if resp.status_code == 429:
+                try:
+                    delay = float(resp.json().get('parameters', {}).get('retry_after', delay))
+                except ValueError:
+                    pass
+                logging.warning(f'Telegram rate limit, nuovo tentativo tra {delay:.0f}s')
+            elif resp.status_code < 500:
+                logging.error(f'Errore invio Telegram ({resp.status_code}): {resp.text}')
+                return False
+            else:
+                logging.warning(f'Errore invio Telegram ({resp.status_code}), nuovo tentativo tra {delay:.0f}s')
+        except Exception as e:
+            logging.warning(f'Errore invio Telegram: {e}, nuovo tentativo tra {delay:.0f}s')
+        if attempt < TELEGRAM_MAX_RETRIES:
+            time.sleep(delay)
+    logging.error(f'Invio Telegram fallito dopo {TELEGRAM_MAX_RETRIES + 1} tentativi')
+    return False
+
+
+def _split_telegram_message(text, limit=None):
+    """Divide text in parti di al massimo limit caratteri (default TELEGRAM_MAX_MESSAGE_LENGTH),
+    spezzando sui ritorni a capo; le righe più lunghe del limite vengono tagliate.
+    """
+    limit = limit or TELEGRAM_MAX_MESSAGE_LENGTH
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f'{current}\n{line}' if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _deliver_telegram(text):
+    for chunk in _split_telegram_message(text):
+        _post_telegram(chunk)
+
+
+def _telegram_dispatcher():
+    """Thread di invio: accorpa i messaggi arrivati entro TELEGRAM_COALESCE_SECONDS in uno solo."""
+    stopping = False
+    while not stopping:
+        message = _telegram_queue.get()
+        if message is None:
+            break
+        parts = [message]
+        length = len(message)
+        deadline = time.monotonic() + TELEGRAM_COALESCE_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                extra = _telegram_queue.get(timeout=remaining) if remaining > 0 else _telegram_queue.get_nowait()
+            except queue.Empty:
+                break
+            if extra is None:
+                stopping = True
+                break
+            if length + len(extra) + 2 > TELEGRAM_MAX_MESSAGE_LENGTH:
+                _deliver_telegram('\n\n'.join(parts))
+                parts, length = [], 0
+            parts.append(extra)
+            length += len(extra) + 2
+        if parts:
+            _deliver_telegram('\n\n'.join(parts))
+
+
+def flush_telegram(timeout=None):
+    """Svuota la coda Telegram e ferma il dispatcher (registrata con atexit)."""
+    global _telegram_thread
+    thread = _telegram_thread
+    if thread is None:
+        return
+    _telegram_thread = None
+    try:
+        _telegram_queue.put(None, timeout=1)
+    except queue.Full:
+        logging.warning('Coda Telegram piena durante la chiusura: alcuni messaggi potrebbero andare persi')
+    thread.join(TELEGRAM_DRAIN_TIMEOUT if timeout is None else timeout)
+    if thread.is_alive():
+        logging.warning('Timeout svuotamento coda Telegram')
+
+
+atexit.register(flush_telegram)
+
+
+def _handle_sigterm(signum, frame):
+    # Kubernetes ferma il pod con SIGTERM, che di default termina il processo senza eseguire atexit:
+    # lo si trasforma in SystemExit, così i blocchi finally e main svuotano la coda prima di uscire
+    logging.info('SIGTERM ricevuto: chiusura in corso')
+    raise SystemExit(128 + signum)
+
 
 def send_telegram_message(message):
+    """Accoda il messaggio al dispatcher asincrono; non blocca mai il chiamante."""
+    global _telegram_thread
+    buffered = getattr(_notification_buffer, 'messages', None)
+    if buffered is not None:
+        buffered.append(message)
+        return
     if not TELEGRAM_ENABLED:
         logging.debug(f"Telegram disabilitato, messaggio non inviato: {message}")
         return
-    url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage'
-    data = {'chat_id': TELEGRAM_CHAT_ID, 'text': message}
+    with _telegram_lock:
+        if _telegram_thread is None:
+            _telegram_thread = threading.Thread(target=_telegram_dispatcher, name='telegram', daemon=True)
+            _telegram_thread.start()
     try:
-        resp = requests.post(url, data=data, timeout=10)
-        if resp.status_code != 200:
-            logging.error(f'Errore invio Telegram ({resp.status_code}): {resp.text}')
-    except Exception as e:
-        logging.error(f'Errore invio Telegram: {e}')
+        _telegram_queue.put_nowait(message)
+    except queue.Full:
+        logging.warning(f'Coda Telegram piena, messaggio scartato: {message}')
 
 
 def telegram_notify_guarded(message):
     """Invia una notifica Telegram solo se non ne è stata inviata una negli ultimi TELEGRAM_NOTIFICATION_INTERVAL secondi."""
     global last_telegram_notification
     now = time.time()
-    if now - last_telegram_notification >= TELEGRAM_NOTIFICATION_INTERVAL:
-        send_telegram_message(message)
+    with _telegram_lock:
+        if now - last_telegram_notification < TELEGRAM_NOTIFICATION_INTERVAL:
+            return
         last_telegram_notification = now
+    send_telegram_message(message)
 
 
 def telegram_force_notify(message):
     """Invia sempre una notifica Telegram e aggiorna il timer (se abilitato)."""
     global last_telegram_notification
     send_telegram_message(message)
-    last_telegram_notification = time.time()
+    with _telegram_lock:
+        last_telegram_notification = time.time()
 
 
-def wait_for_stable_folder(folder, stable_seconds=20, check_interval=2):
-    """Attende che la dimensione della cartella non cambi per stable_seconds."""
-    last_size = -1
-    stable_time = 0
-    elapsed = 0
-    log_interval = 30  # secondi
-    last_log = 0
-    while stable_time < stable_seconds:
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(folder):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                if os.path.isfile(fp):
-                    try:
-                        total_size += os.path.getsize(fp)
-                    except Exception:
-                        pass
-        if total_size == last_size:
-            stable_time += check_interval
-        else:
-            stable_time = 0
-            last_size = total_size
-        elapsed += check_interval
-        # Log interno ogni log_interval secondi
-        if elapsed - last_log >= log_interval:
-            logging.info(f"[wait_for_stable_folder] {folder}: dimensione attuale {total_size / (1024*1024):.2f} MB, stabile da {stable_time}s")
-            last_log = elapsed
-            # Notifica di stato a bassa priorità
-            telegram_notify_guarded(f'⏳ Attesa stabilità cartella {folder}: attuale {total_size / (1024*1024):.2f} MB, stabile da {stable_time}s')
-        time.sleep(check_interval)
+# Registro metriche minimale in formato testo Prometheus (nessuna dipendenza aggiuntiva)
+METRICS = {
+    'gfc_stage_duration_seconds': ('histogram', 'Durata delle fasi di lavorazione per cartella'),
+    'gfc_scan_duration_seconds': ('histogram', 'Durata di un ciclo di scan completo'),
+    'gfc_last_scan_duration_seconds': ('gauge', 'Durata dell\'ultimo ciclo di scan'),
+    'gfc_deleted_bytes_total': ('counter', 'Byte eliminati'),
+    'gfc_deleted_inodes_total': ('counter', 'File e cartelle eliminati'),
+    'gfc_syscall_errors_total': ('counter', 'Errori delle chiamate di sistema per operazione ed errno'),
+    'gfc_folders_total': ('counter', 'Cartelle lavorate per esito e tipo di gioco'),
+    'gfc_disk_usage_ratio': ('gauge', 'Frazione occupata del volume monitorato a inizio ciclo'),
+    'gfc_io_rate_limit': ('gauge', 'Limite corrente del governor I/O in operazioni al secondo'),
+    'gfc_io_throttled_seconds_total': ('counter', 'Secondi di attesa imposti dal governor I/O'),
+    'gfc_dedup_bytes_total': ('counter', 'Byte recuperati deduplicando i salvataggi'),
+}
+METRICS_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, float('inf'))
+_metrics_lock = threading.Lock()
+_metric_values = {}  # (nome, labels) -> valore, oppure [bucket..., somma, conteggio] per gli istogrammi
 
 
-def is_renpy_game(folder):
-    # Riconosce sia /game/saves che /QUALCOSA/game/saves (un solo livello)
-    try:
-        if os.path.isdir(os.path.join(folder, 'game', 'saves')):
-            return True
-        # Cerca un solo livello sotto
-        for entry in os.listdir(folder):
-            sub = os.path.join(folder, entry)
-            if os.path.isdir(sub) and os.path.isdir(os.path.join(sub, 'game', 'saves')):
-                return True
-    except Exception:
-        pass
-    return False
+def _metric_key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
 
 
-def is_rpgm_game(folder):
-    try:
-        if os.path.isdir(os.path.join(folder, 'www', 'save')):
-            return True
-        for entry in os.listdir(folder):
-            sub = os.path.join(folder, entry)
-            if os.path.isdir(sub) and os.path.isdir(os.path.join(sub, 'www', 'save')):
-                return True
-    except Exception:
-        pass
-    return False
+def metric_inc(name, value=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = _metric_values.get(key, 0) + value
+
+
+def metric_set(name, value, **labels):
+    if not METRICS_ENABLED:
+        return
+    with _metrics_lock:
+        _metric_values[_metric_key(name, labels)] = value
+
+
+def metric_observe(name, value, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        data = _metric_values.setdefault(key, [0] * (len(METRICS_BUCKETS) + 2))
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
 
 
-def flatten_folder(folder):
-    # Se la struttura è /NOME_GIOCO/QUALCOSA/game/saves o /NOME_GIOCO/QUALCOSA/www/save, sposta tutto su un livello sopra
+def metric_errno(op, err):
+    """Conta un errore di sistema per operazione ed errno simbolico."""
+    if METRICS_ENABLED:
+        code = getattr(err, 'errno', None)
+        metric_inc('gfc_syscall_errors_total', op=op, errno=errno.errorcode.get(code, str(code)))
+
+
+@contextmanager
+def _timed(name, labels):
+    start = time.monotonic()
     try:
-        for entry in os.listdir(folder):
-            candidate = os.path.join(folder, entry)
-            if os.path.isdir(candidate):
-                if os.path.isdir(os.path.join(candidate, 'game', 'saves')) or os.path.isdir(os.path.join(candidate, 'www', 'save')):
-                    # Sposta tutto su un livello sopra
-                    for item in os.listdir(candidate):
-                        shutil.move(os.path.join(candidate, item), os.path.join(folder, item))
-                    shutil.rmtree(candidate)
-                    logging.info(f'Rimossa cartella annidata: {candidate}')
-                    break
-    except Exception as e:
-        logging.warning(f'Errore in flatten_folder per {folder}: {e}')
+        yield
+    finally:
+        metric_observe(name, time.monotonic() - start, **labels)
 
 
-def set_permissions(folder):
-    """Cerca di impostare ownership (uid/gid corrente) e chmod 777 ricorsivamente su folder.
-    Se fallisce invia una notifica Telegram e ritorna False; altrimenti True.
+def stage_timer(stage, root=None):
+    """Context manager che misura la durata di una fase (con l'etichetta root della radice, se indicata);
+    senza metriche è un nullcontext (costo trascurabile).
     """
-    failed = []
-    modified_count = 0
-    try:
-        try:
-            uid = os.getuid()
-            gid = os.getgid()
-        except AttributeError:
-            # In ambienti senza getuid (molto raro), fallback a root
-            uid = 0
-            gid = 0
+    if not METRICS_ENABLED:
+        return nullcontext()
+    labels = {'stage': stage}
+    if root is not None:
+        labels['root'] = root
+    return _timed('gfc_stage_duration_seconds', labels)
 
-        for root, dirs, files in os.walk(folder):
-            # directory
-            try:
-                os.chown(root, uid, gid)
-                modified_count += 1
-            except Exception as e:
-                failed.append(root)
-            try:
-                os.chmod(root, 0o777)
-                modified_count += 1
-            except Exception:
-                failed.append(root)
-            # files
-            for f in files:
-                fp = os.path.join(root, f)
-                try:
-                    os.chown(fp, uid, gid)
-                    modified_count += 1
-                except Exception:
-                    failed.append(fp)
-                try:
-                    os.chmod(fp, 0o777)
-                    modified_count += 1
-                except Exception:
-                    failed.append(fp)
 
-        # Rimuovo duplicati e mantengo ordine
-        failed = list(dict.fromkeys(failed))
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-        if failed:
-            # manda notifica di fallimento con alcuni esempi
-            sample = failed[:5]
-            msg = f'❌ Fallita impostazione permessi per {os.path.basename(folder)}: permessi mancanti su {len(failed)} oggetti. Esempi: {sample}'
-            logging.error(msg)
-            try:
-                telegram_force_notify(msg)
-            except Exception:
-                logging.debug('Invio notifica Telegram fallito durante set_permissions (fail)')
-            return False
 
-        # tutto ok
-        msg = f'✅ Permessi impostati correttamente per {os.path.basename(folder)}: {modified_count} operazioni effettuate'
-        logging.info(msg)
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape_label(v)}"' for k, v in items) + '}'
+
+
+def render_metrics():
+    """Esporta tutte le metriche nel formato testo di Prometheus."""
+    with _metrics_lock:
+        values = {k: (list(v) if isinstance(v, list) else v) for k, v in _metric_values.items()}
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        series = sorted((labels, v) for (n, labels), v in values.items() if n == name)
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind == 'histogram':
+                for bound, count in zip(METRICS_BUCKETS, value):
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", le)])} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f'[metrics] {self.address_string()} {format % args}')
+
+
+def start_metrics_server(port=None):
+    """Avvia l'endpoint HTTP /metrics in un thread in background."""
+    port = port or METRICS_PORT
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f'Metriche Prometheus esposte su :{port}/metrics')
+    return server
+
+
+def export_metrics():
+    """Scrive le metriche su METRICS_TEXTFILE (in modo atomico) e/o le invia al Pushgateway."""
+    if not METRICS_ENABLED:
+        return
+    text = render_metrics()
+    if METRICS_TEXTFILE:
         try:
-            telegram_force_notify(msg)
-        except Exception:
-            logging.debug('Invio notifica Telegram fallito durante set_permissions (success)')
-        return True
-    except Exception as e:
-        logging.error(f'Errore critico impostazione permessi per {folder}: {e}')
+            tmp = f'{METRICS_TEXTFILE}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, METRICS_TEXTFILE)
+        except Exception as e:
+            logging.error(f'Impossibile scrivere metriche su {METRICS_TEXTFILE}: {e}')
+    if METRICS_PUSHGATEWAY:
+        url = f"{METRICS_PUSHGATEWAY.rstrip('/')}/metrics/job/game_folder_cleaner"
+        if SHARD_SPEC[1] > 1:
+            # Un gruppo per shard: senza chiave ogni pod sovrascriverebbe le metriche degli altri
+            url += f'/shard/{SHARD_SPEC[0]}-{SHARD_SPEC[1]}'
         try:
-            telegram_force_notify(f'❌ Fallita impostazione permessi per {folder}: {e}')
-        except Exception:
-            logging.debug('Invio notifica Telegram fallito durante set_permissions (except)')
-        return False
+            resp = requests.put(url, data=text.encode('utf-8'), timeout=10)
+            if resp.status_code >= 300:
+                logging.error(f'Errore invio metriche al Pushgateway ({resp.status_code}): {resp.text}')
+        except Exception as e:
+            logging.error(f'Errore invio metriche al Pushgateway: {e}')
 
 
-def log_folder_action(folder, action, result, space_saved=None):
-    try:
-        os.makedirs(FOLDER_WATCHED, exist_ok=True)
-        log_file = os.path.join(FOLDER_WATCHED, 'folders_log.csv')
-        file_exists = os.path.isfile(log_file)
-        with open(log_file, 'a', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            if not file_exists:
-                writer.writerow(['timestamp', 'folder', 'action', 'result', 'space_saved_MB'])
-            writer.writerow([
-                datetime.now().isoformat(),
-                folder,
-                action,
-                result,
-                f"{space_saved:.2f}" if space_saved is not None else ''
-            ])
-        # Imposta permessi 777 dopo ogni scrittura
+class _TokenBucket:
+    """Token bucket thread-safe: rate operazioni al secondo con una riserva di un secondo."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Prende un token; ritorna i secondi attesi."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class _IoGovernor:
+    """Limita le operazioni sul filesystem per tipo ('metadata', 'unlink') con un token bucket ciascuno.
+    Con un obiettivo di latenza adatta i limiti in stile AIMD: dimezza il rate quando la media mobile
+    della latenza supera l'obiettivo, lo rialza del 10% del valore configurato quando torna sotto.
+    """
+
+    ADJUST_INTERVAL = 1.0  # secondi minimi tra due adattamenti
+    MIN_RATE_FRACTION = 0.05  # il rate non scende sotto il 5% di quello configurato
+
+    def __init__(self, rates, latency_target=0.0):
+        self.base = {kind: rate for kind, rate in rates.items() if rate > 0}
+        self.buckets = {kind: _TokenBucket(rate) for kind, rate in self.base.items()}
+        self.latency_target = latency_target
+        self.latency = {kind: 0.0 for kind in self.base}
+        self.last_adjust = {kind: 0.0 for kind in self.base}
+        self.lock = threading.Lock()
+        for kind, rate in self.base.items():
+            metric_set('gfc_io_rate_limit', rate, kind=kind)
+
+    @classmethod
+    def from_env(cls):
+        """Governor configurato dalle variabili IO_*, o None se non c'è nessun limite."""
+        if not IO_METADATA_RATE and not IO_UNLINK_RATE:
+            return None
+        return cls({'metadata': IO_METADATA_RATE, 'unlink': IO_UNLINK_RATE}, IO_LATENCY_TARGET_MS / 1000)
+
+    def call(self, kind, func, *args, **kwargs):
+        """Esegue func(*args, **kwargs) rispettando il limite di kind e ne registra la latenza."""
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            return func(*args, **kwargs)
+        waited = bucket.acquire()
+        if waited:
+            metric_inc('gfc_io_throttled_seconds_total', waited, kind=kind)
+        if not self.latency_target:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
         try:
-            os.chmod(log_file, 0o777)
-        except Exception as e:
-            logging.warning(f'Impossibile impostare permessi 777 su {log_file}: {e}')
-    except Exception as e:
-        logging.error(f'Impossibile scrivere log azione per {folder}: {e}')
+            return func(*args, **kwargs)
+        finally:
+            self._observe(kind, time.perf_counter() - start)
+
+    def _observe(self, kind, latency):
+        with self.lock:
+            self.latency[kind] = 0.9 * self.latency[kind] + 0.1 * latency
+            now = time.monotonic()
+            if now - self.last_adjust[kind] < self.ADJUST_INTERVAL:
+                return
+            self.last_adjust[kind] = now
+            bucket = self.buckets[kind]
+            base = self.base[kind]
+            if self.latency[kind] > self.latency_target:
+                rate = max(bucket.rate / 2, base * self.MIN_RATE_FRACTION)
+            else:
+                rate = min(bucket.rate + base * 0.1, base)
+            if rate != bucket.rate:
+                logging.debug(f'Governor I/O: {kind} da {bucket.rate:.0f} a {rate:.0f} op/s '
+                              f'(latenza media {self.latency[kind] * 1000:.1f} ms)')
+                with bucket.lock:
+                    bucket.rate = rate
+                    bucket.tokens = min(bucket.tokens, rate)
+                metric_set('gfc_io_rate_limit', rate, kind=kind)
+
 
+# Governor attivo (None = nessun limite: le funzioni chiamano direttamente il filesystem)
+_io_governor = _IoGovernor.from_env()
 
-def get_total_space_saved():
-    log_file = os.path.join(FOLDER_WATCHED, 'folders_log.csv')
-    total = 0.0
-    if not os.path.isfile(log_file):
-        return 0.0
+
+def io_call(kind, func, *args, **kwargs):
+    """Esegue una chiamata al filesystem passando dal governor I/O, se configurato."""
+    governor = _io_governor
+    if governor is None:
+        return func(*args, **kwargs)
+    return governor.call(kind, func, *args, **kwargs)
+
+
+# Numero della syscall ioprio_set per architettura (non esposta da os né dalla libc)
+_IOPRIO_SET_SYSCALL = {'x86_64': 251, 'aarch64': 30, 'i386': 289, 'i686': 289, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+_IOPRIO_CLASSES = {'best-effort': 2, 'idle': 3}
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+
+
+def set_io_priority(priority=None):
+    """Abbassa la priorità I/O del processo con ioprio_set ('idle' o 'best-effort:N').
+    Va chiamata prima di avviare i thread, che ereditano la priorità. Ritorna True se applicata.
+    Nota: lo scheduler I/O agisce sui dischi locali; su NFS l'effetto è limitato e serve il governor.
+    """
+    priority = IO_PRIORITY if priority is None else priority
+    if not priority:
+        return False
+    name, _, level = priority.partition(':')
+    if name not in _IOPRIO_CLASSES:
+        logging.warning(f"IO_PRIORITY '{priority}' non valida: usare 'idle' o 'best-effort:N'")
+        return False
+    number = _IOPRIO_SET_SYSCALL.get(platform.machine())
+    if number is None:
+        logging.warning(f'ioprio_set non supportata su {platform.machine()}')
+        return False
     try:
-        with open(log_file, 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                try:
-                    val = float(row.get('space_saved_MB', '0') or 0)
-                    total += val
-                except Exception:
-                    pass
-    except Exception as e:
-        logging.error(f'Errore lettura log totale spazio: {e}')
-    return total
+        data = min(7, max(0, int(level))) if level else (0 if name == 'idle' else 7)
+    except ValueError:
+        logging.warning(f"Livello IO_PRIORITY '{level}' non valido")
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    value = (_IOPRIO_CLASSES[name] << _IOPRIO_CLASS_SHIFT) | data
+    if libc.syscall(number, _IOPRIO_WHO_PROCESS, 0, value) < 0:
+        logging.warning(f'ioprio_set fallita: {os.strerror(ctypes.get_errno())}')
+        return False
+    logging.info(f'Priorità I/O impostata a {priority}')
+    return True
 
 
-def get_folder_size(folder):
-    total_size = 0
+# Una entry dello snapshot dell'albero: dati presi da una sola DirEntry.stat(follow_symlinks=False)
+TreeEntry = namedtuple('TreeEntry', ['path', 'is_dir', 'size', 'mode', 'uid', 'gid', 'ino', 'mtime'])
+
+
+def _tree_entry(path, st):
+    is_dir = stat.S_ISDIR(st.st_mode)
+    return TreeEntry(path, is_dir, 0 if is_dir else st.st_size, st.st_mode, st.st_uid, st.st_gid, st.st_ino, st.st_mtime)
+
+
+def iter_tree(folder):
+    """Visita folder con os.scandir producendo una TreeEntry per ogni oggetto (root inclusa).
+    Ogni entry costa una sola stat; le directory vengono prodotte prima del loro contenuto.
+    I symlink non vengono seguiti e sono trattati come file.
+    """
     try:
-        for dirpath, dirnames, filenames in os.walk(folder):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                if os.path.isfile(fp):
+        yield _tree_entry(folder, io_call('metadata', os.stat, folder, follow_symlinks=False))
+    except OSError:
+        return
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        try:
+            with io_call('metadata', os.scandir, current) as it:
+                for entry in it:
                     try:
-                        total_size += os.path.getsize(fp)
-                    except Exception:
-                        pass
-    except Exception:
-        pass
-    return total_size
+                        tree_entry = _tree_entry(entry.path, io_call('metadata', entry.stat, follow_symlinks=False))
+                    except OSError as e:
+                        metric_errno('stat', e)
+                        continue
+                    yield tree_entry
+                    if tree_entry.is_dir:
+                        stack.append(entry.path)
+        except OSError as e:
+            metric_errno('scandir', e)
 
 
-def is_folder_already_processed(folder):
-    log_file = os.path.join(FOLDER_WATCHED, 'folders_log.csv')
-    if not os.path.isfile(log_file):
-        return False
-    try:
-        with open(log_file, 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if row.get('folder') == folder:
-                    return True
-    except Exception:
-        pass
-    return False
+def scan_tree(folder):
+    """Snapshot completo di folder: lista di TreeEntry condivisa da stabilità, permessi, dimensioni e pulizia."""
+    return list(iter_tree(folder))
+
 
+def snapshot_size(snapshot, under=None):
+    """Somma le dimensioni dei file dello snapshot (opzionalmente solo quelli sotto il path under)."""
+    if under is None:
+        return sum(e.size for e in snapshot)
+    prefix = under + os.sep
+    return sum(e.size for e in snapshot if e.path == under or e.path.startswith(prefix))
 
-def clean_game_folder(folder):
+
+@contextmanager
+def collect_notifications():
+    """Accumula le notifiche del thread corrente e le invia come un unico messaggio all'uscita.
+    Usato dai worker paralleli per non mescolare i messaggi di cartelle diverse.
+    """
+    _notification_buffer.messages = []
     try:
-        if is_renpy_game(folder):
-            save_path = os.path.join(folder, 'game', 'saves')
-            keep_paths = {save_path}
-            # Mantieni anche la cartella 'game' e la root
-            keep_dirs = {os.path.join(folder, 'game'), folder}
-            game_type = 'RenPy'
-        elif is_rpgm_game(folder):
-            save_path = os.path.join(folder, 'www', 'save')
-            keep_paths = {save_path}
-            keep_dirs = {os.path.join(folder, 'www'), folder}
-            game_type = 'RPGM'
-        else:
-            logging.warning(f"Tipo di gioco non riconosciuto per la cartella: {folder}")
-            telegram_force_notify(f'❌ Tipo di gioco non riconosciuto in {folder}')
-            log_folder_action(folder, 'clean', 'Tipo di gioco non riconosciuto')
-            return
-        # Calcola dimensione prima
-        size_before = get_folder_size(folder)
-        # nome gioco per messaggi
-        game_name = os.path.basename(folder)
-        # Elimina tutto tranne la cartella dei salvataggi e la sua gerarchia
-        to_delete_dirs = []
-        to_delete_files = []
-        permission_errors = False
-        failed_paths = []
-        for root, dirs, files in os.walk(folder):
-            # Elimina cartelle che non sono la root, né 'game'/'www', né 'game/saves'/'www/save'
-            for d in dirs:
-                full_path = os.path.join(root, d)
-                # Non eliminare la cartella 'game', 'www', 'game/saves', 'www/save', né la root
-                if full_path not in keep_dirs and full_path not in keep_paths:
-                    to_delete_dirs.append(full_path)
-            for f in files:
-                file_path = os.path.join(root, f)
-                # Non eliminare file dentro la cartella dei salvataggi
-                if not file_path.startswith(save_path + os.sep):
-                    to_delete_files.append(file_path)
-
-        total_dirs = len(to_delete_dirs)
-        total_files = len(to_delete_files)
-        logging.info(f"[clean_game_folder] Da eliminare: {total_dirs} cartelle, {total_files} file in {folder}")
-
-        # Eliminazione cartelle con log e notifiche di progresso
-        last_log = time.time()
-        last_tg = time.time()
-        for idx, d in enumerate(to_delete_dirs, 1):
-            try:
-                shutil.rmtree(d)
-                logging.info(f'Eliminata cartella: {d} ({idx}/{total_dirs})')
-            except Exception as e:
-                logging.error(f'Errore eliminazione {d}: {e}')
-                # Se è un errore di permessi, segnalo e salvo il path
-                if isinstance(e, PermissionError) or getattr(e, 'errno', None) == 13:
-                    permission_errors = True
-                    failed_paths.append(d)
-            now = time.time()
-            if now - last_log >= 30:
-                logging.info(f"[clean_game_folder] Eliminazione cartelle: {idx}/{total_dirs} in {folder}")
-                last_log = now
-            if now - last_tg >= 300:
-                telegram_notify_guarded(f'🗑️ Eliminazione cartelle: {idx}/{total_dirs} in {folder}')
-                last_tg = now
-
-        # Eliminazione file con log e notifiche di progresso
-        last_log = time.time()
-        last_tg = time.time()
-        for idx, fpath in enumerate(to_delete_files, 1):
-            try:
-                os.remove(fpath)
-                logging.info(f'Eliminato file: {fpath} ({idx}/{total_files})')
-            except Exception as e:
-                logging.error(f'Errore eliminazione {fpath}: {e}')
-                if isinstance(e, PermissionError) or getattr(e, 'errno', None) == 13:
-                    permission_errors = True
-                    failed_paths.append(fpath)
-            now = time.time()
-            if now - last_log >= 30:
-                logging.info(f"[clean_game_folder] Eliminazione file: {idx}/{total_files} in {folder}")
-                last_log = now
-            if now - last_tg >= 300:
-                telegram_notify_guarded(f'🗑️ Eliminazione file: {idx}/{total_files} in {folder}')
-                last_tg = now
-        # Se ci sono errori di permessi, notifica e non segnare la cartella come pulita
-        if permission_errors:
-            sample = failed_paths[:3]
-            telegram_force_notify(f'❌ Impossibile completare pulizia di {game_name}: permessi insufficienti su {len(failed_paths)} oggetti. Esempi: {sample}')
-            log_folder_action(folder, 'clean', f'Fallita per permessi in {game_type}', None)
-            return
+        yield
+    finally:
+        messages = _notification_buffer.messages
+        _notification_buffer.messages = None
+        if messages:
+            send_telegram_message('\n\n'.join(messages))
 
-        # Calcola dimensione dopo
-        size_after = get_folder_size(folder)
-        space_saved = (size_before - size_after) / (1024 * 1024)  # MB
-        total_saved = get_total_space_saved() + space_saved
 
-        telegram_force_notify(
-            f'🧹 Pulito gioco {game_name}\n'
-            f'✅ Pulizia completata per {game_type}\n'
-            f'Spazio risparmiato in questa cartella: {space_saved:.2f} MB\n'
-            f'Totale risparmiato: {total_saved:.2f} MB'
-        )
-        log_folder_action(folder, 'clean', f'Pulizia completata per {game_type}', space_saved)
-    except Exception as e:
-        logging.error(f'Errore in clean_game_folder({folder}): {e}')
+class _IncrementalTree:
+    """Snapshot aggiornabile in modo incrementale per l'attesa di stabilità.
+    A ogni refresh ristatta le directory (rileggendo quelle con mtime cambiato), i file "caldi"
+    (nuovi, cambiati durante l'attesa o scritti poco prima del file più recente dell'albero) e una fetta
+    a rotazione degli altri file, così ogni file viene ricontrollato senza confrontare l'mtime del server
+    con l'orologio locale (su NFS i due possono differire).
+    """
 
+    def __init__(self, folder, hot_window=0):
+        self.folder = folder
+        self.entries = {}
+        self.children = {}
+        for entry in iter_tree(folder):
+            self._add(entry)
+        # Riferimento temporale dal server stesso: l'mtime più recente dell'albero
+        newest = max((entry.mtime for entry in self.entries.values()), default=0)
+        self.hot = {path for path, entry in self.entries.items()
+                    if not entry.is_dir and entry.mtime >= newest - hot_window}
+        self.sweeps = 0  # giri completi sui file non caldi
+        self._sweep = []
+        self._cursor = 0
+        self._batch = 0
 
-def scan_and_process_folders():
-    telegram_force_notify(f'🔄 Inizio scan cartelle in {FOLDER_WATCHED}')
-    if not os.path.isdir(FOLDER_WATCHED):
-        logging.warning(f"La cartella da monitorare non esiste: {FOLDER_WATCHED}")
-        return
-    nuove_cartelle = []
-    entries = sorted(os.listdir(FOLDER_WATCHED))
-    for idx, entry in enumerate(entries):
-        folder = os.path.join(FOLDER_WATCHED, entry)
-        if os.path.isdir(folder) and not is_folder_already_processed(folder):
-            logging.info(f"Nuova cartella trovata: {folder}")
-            telegram_notify_guarded(f'📁 Sto per processare la cartella: {folder} ({idx+1}/{len(entries)})')
-            wait_for_stable_folder(folder)
-            # Prova a impostare ownership/permessi prima di partire
-            perms_ok = set_permissions(folder)
-            if not perms_ok:
-                logging.warning(f"Saltata cartella per fallimento impostazione permessi: {folder}")
-                # set_permissions invia già una notifica Telegram in caso di errore
+    def _add(self, entry):
+        self.entries[entry.path] = entry
+        if entry.path != self.folder:
+            self.children.setdefault(os.path.dirname(entry.path), set()).add(entry.path)
+        if entry.is_dir:
+            self.children.setdefault(entry.path, set())
+
+    def _drop(self, path):
+        for child in self.children.pop(path, ()):
+            self._drop(child)
+        self.entries.pop(path, None)
+        self.hot.discard(path)
+        siblings = self.children.get(os.path.dirname(path))
+        if siblings is not None:
+            siblings.discard(path)
+
+    def _rescan_dir(self, path):
+        present = set()
+        try:
+            with io_call('metadata', os.scandir, path) as it:
+                for dir_entry in it:
+                    present.add(dir_entry.path)
+                    known = self.entries.get(dir_entry.path)
+                    if known is not None and known.is_dir:
+                        continue  # già seguita: verrà controllata col suo mtime
+                    try:
+                        entry = _tree_entry(dir_entry.path, io_call('metadata', dir_entry.stat, follow_symlinks=False))
+                    except OSError:
+                        present.discard(dir_entry.path)
+                        continue
+                    new_entries = iter_tree(entry.path) if entry.is_dir else [entry]
+                    for new_entry in new_entries:
+                        self._add(new_entry)
+                        if not new_entry.is_dir:
+                            self.hot.add(new_entry.path)
+        except OSError:
+            pass
+        for gone in self.children.get(path, set()) - present:
+            self._drop(gone)
+
+    def sweep_mark(self):
+        """Valore di sweeps dopo il quale tutti i file sono stati ricontrollati almeno una volta da adesso."""
+        in_progress = 0 < self._cursor < len(self._sweep)
+        return self.sweeps + (2 if in_progress else 1)
+
+    def refresh(self, passes=1):
+        """Aggiorna lo snapshot; ritorna True se è cambiato qualcosa.
+        Gli altri file vengono ricontrollati a rotazione, un giro completo ogni passes refresh.
+        """
+        if self._cursor >= len(self._sweep):
+            self._sweep = [path for path, entry in self.entries.items() if not entry.is_dir and path not in self.hot]
+            self._cursor = 0
+            self._batch = -(-len(self._sweep) // max(1, passes))
+        sweep = self._sweep[self._cursor:self._cursor + self._batch]
+        self._cursor += self._batch
+        if self._cursor >= len(self._sweep):
+            self.sweeps += 1
+        dirs = [path for path, entry in self.entries.items() if entry.is_dir]
+        changed = False
+        for path in dict.fromkeys(dirs + list(self.hot) + sweep):
+            entry = self.entries.get(path)
+            if entry is None:
+                continue  # rimosso durante questo refresh
+            try:
+                current = _tree_entry(path, io_call('metadata', os.stat, path, follow_symlinks=False))
+            except OSError:
+                self._drop(path)
+                changed = True
                 continue
-            flatten_folder(folder)
-            clean_game_folder(folder)
-            nuove_cartelle.append(folder)
-        else:
-            # Notifica periodica se la scansione è lunga e non ci sono nuove cartelle
-            telegram_notify_guarded(f'🔎 Scansione in corso in {FOLDER_WATCHED}... ({idx+1}/{len(entries)})')
-    total_saved = get_total_space_saved()
-    telegram_force_notify(
-        f'✅ Fine ciclo pulizia. Cartelle lavorate: {len(nuove_cartelle)}\n'
-        f'Totale spazio risparmiato: {total_saved:.2f} MB'
-    )
+            if current.mtime == entry.mtime and current.size == entry.size:
+                continue
+            changed = True
+            self.entries[path] = current
+            if current.is_dir:
+                self._rescan_dir(path)
+            else:
+                self.hot.add(path)
+        return changed
 
-    # Dopo la fine ciclo, elenca giochi non riconosciuti
-    try:
-        log_file = os.path.join(FOLDER_WATCHED, 'folders_log.csv')
-        if os.path.isfile(log_file):
-            with open(log_file, 'r', newline='') as csvfile:
-                reader = csv.DictReader(csvfile)
-                non_riconosciuti = [row['folder'] for row in reader if row.get('result') == 'Tipo di gioco non riconosciuto']
-            if non_riconosciuti:
-                msg = '⚠️ Giochi non riconosciuti da risolvere manualmente:\n' + '\n'.join(non_riconosciuti)
-                telegram_force_notify(msg)
-    except Exception as e:
-        logging.error(f'Errore controllo giochi non riconosciuti: {e}')
+    def snapshot(self):
+        # Ordinando per path ogni directory precede il proprio contenuto, come in scan_tree
+        return sorted(self.entries.values())
 
 
-def parse_args():
-    p = argparse.ArgumentParser(description='Game Folder Cleaner')
-    p.add_argument('--once', action='store_true', help='Esegui una sola scansione e termina')
-    p.add_argument('--folder', type=str, help='Sovrascrive FOLDER_WATCHED')
-    p.add_argument('--check-interval', type=int, help='Sovrascrive CHECK_INTERVAL in secondi')
-    p.add_argument('--debug', action='store_true', help='Abilita log di debug')
-    return p.parse_args()
+def wait_for_stable_folder(folder, stable_seconds=None, check_interval=None, max_wait=None):
+    """Attende che la cartella non cambi per stable_seconds (default STABLE_SECONDS).
+    I controlli sono incrementali: a ogni giro vengono ristattate le directory, i file in scrittura e
+    una parte degli altri, e la cartella è stabile solo dopo che tutti i file sono stati ricontrollati.
+    Ritorna lo snapshot finale dell'albero, riutilizzabile dalle fasi successive,
+    oppure None se la cartella non si è stabilizzata entro max_wait secondi (default STABLE_MAX_WAIT).
+    """
+    stable_seconds = STABLE_SECONDS if stable_seconds is None else stable_seconds
+    check_interval = STABLE_CHECK_INTERVAL if check_interval is None else check_interval
+    max_wait = STABLE_MAX_WAIT if max_wait is None else max_wait
+    log_interval = 30  # secondi
+    # File scritti negli ultimi stable_seconds (più margine) prima del più recente sono considerati in scrittura
+    tree = _IncrementalTree(folder, stable_seconds + check_interval)
+    # Due giri completi sugli altri file entro stable_seconds: uno può essere già a metà quando arriva una modifica
+    passes = max(1, int(stable_seconds / check_interval) // 2) if check_interval else 1
+    need_sweeps = tree.sweep_mark()
+    start = last_change = last_log = time.monotonic()
+    while True:
+        time.sleep(check_interval)
+        now = time.monotonic()
+        if tree.refresh(passes):
+            last_change = now
+            need_sweeps = tree.sweep_mark()
+        stable_time = now - last_change
+        if stable_time >= stable_seconds and tree.sweeps >= need_sweeps:
+            return tree.snapshot()
+        if max_wait and now - start >= max_wait:
+            logging.warning(f"[wait_for_stable_folder] {folder}: non stabile dopo {max_wait:.0f}s, rinvio al prossimo ciclo")
+            return None
+        # Log interno ogni log_interval secondi
+        if now - last_log >= log_interval:
+            total_size = snapshot_size(tree.entries.values())
+            logging.info(f"[wait_for_stable_folder] {folder}: dimensione attuale {total_size / (1024*1024):.2f} MB, stabile da {stable_time:.0f}s")
+            last_log = now
+            # Notifica di stato a bassa priorità
+            telegram_notify_guarded(f'⏳ Attesa stabilità cartella {folder}: attuale {total_size / (1024*1024):.2f} MB, stabile da {stable_time:.0f}s')
 
 
-def main():
-    args = parse_args()
-    global FOLDER_WATCHED, CHECK_INTERVAL
-    if args.debug:
-        logging.getLogger().setLevel(logging.DEBUG)
-    if args.folder:
-        FOLDER_WATCHED = args.folder
-    if args.check_interval:
-        CHECK_INTERVAL = args.check_interval
+# Registro dei motori di gioco riconosciuti, in ordine di priorità.
+# markers: path relativi (componenti con wildcard fnmatch) che devono esistere tutti nella root del gioco;
+#          un marker uguale a save_dir deve essere una directory, gli altri possono essere file
+# save_dir: path relativo della cartella dei salvataggi da mantenere (() = la root stessa)
+# save_files: pattern dei soli file da mantenere in save_dir (None = tutta la cartella)
+GAME_ENGINES = [
+    {'name': 'RenPy', 'markers': [('game', 'saves')], 'save_dir': ('game', 'saves'), 'save_files': None},
+    {'name': 'RPGM', 'markers': [('www', 'save')], 'save_dir': ('www', 'save'), 'save_files': None},
+    {'name': 'RPGM MZ', 'markers': [('js', 'rmmz_core.js'), ('save',)], 'save_dir': ('save',), 'save_files': None},
+    {'name': 'RPGM VX Ace', 'markers': [('Game.ini',), ('Save*.rvdata2',)], 'save_dir': (), 'save_files': 'Save*.rvdata2'},
+    {'name': 'Unity', 'markers': [('*_Data', '[Ss]aves')], 'save_dir': ('*_Data', '[Ss]aves'), 'save_files': None},
+]
 
-    # Se in container, esegui una sola scansione di default (comportamento CronJob)
-    run_once = args.once or os.getenv('CONTAINER_MODE', '').lower() == 'true'
+# Esito del riconoscimento: motore, root effettiva del gioco (eventualmente annidata), cartella salvataggi risolta
+GameDetection = namedtuple('GameDetection', ['engine', 'root', 'save_dir', 'save_files'])
 
-    logging.info(f'In ascolto su {FOLDER_WATCHED}... (v{APP_VERSION})')
-    telegram_force_notify(f'🚀 Game Folder Cleaner v{APP_VERSION} avviato e in ascolto su {FOLDER_WATCHED}')
+# Cache folder -> (mtime delle directory lette, GameDetection o None)
+_detection_cache = {}
+_detection_lock = threading.Lock()
 
+
+def register_game_engine(name, markers, save_dir, save_files=None):
+    """Aggiunge un motore al registro (in coda, quindi con priorità più bassa di quelli esistenti)."""
+    GAME_ENGINES.append({'name': name, 'markers': list(markers), 'save_dir': tuple(save_dir), 'save_files': save_files})
+
+
+def _resolve_rel_path(base, components, listdir, want_dir=False):
+    """Risolve components (con wildcard) sotto base usando listdir; ritorna il primo path esistente o None.
+
+    Le componenti intermedie devono essere directory; con want_dir anche l'ultima.
+    """
+    if not components:
+        return base
+    names = listdir(base)
+    if not names:
+        return None
+    head, rest = components[0], components[1:]
+    if any(c in head for c in '*?['):
+        candidates = sorted(n for n in names if fnmatch.fnmatchcase(n, head))
+    else:
+        candidates = [head] if head in names else []
+    for name in candidates:
+        if (rest or want_dir) and not names[name]:
+            continue
+        found = _resolve_rel_path(os.path.join(base, name), rest, listdir, want_dir)
+        if found:
+            return found
+    return None
+
+
+def _match_engine(root, listdir):
+    for engine in GAME_ENGINES:
+        if all(_resolve_rel_path(root, marker, listdir, want_dir=tuple(marker) == engine['save_dir'])
+               for marker in engine['markers']):
+            save_dir = _resolve_rel_path(root, engine['save_dir'], listdir, want_dir=True)
+            if save_dir:
+                return GameDetection(engine['name'], root, save_dir, engine['save_files'])
+    return None
+
+
+def _detection_valid(mtimes):
+    try:
+        return all(io_call('metadata', os.stat, path).st_mtime_ns == mtime for path, mtime in mtimes.items())
+    except OSError:
+        return False
+
+
+def detect_game(folder):
+    """Riconosce il motore del gioco in folder (o in una sua sottocartella di primo livello).
+    Ogni directory viene letta al massimo una volta con os.scandir; l'esito viene messo in cache
+    e riutilizzato finché non cambia l'mtime di nessuna delle directory lette.
+    Ritorna una GameDetection o None se il tipo non è riconosciuto.
+    """
+    with _detection_lock:
+        cached = _detection_cache.get(folder)
+    if cached is not None and _detection_valid(cached[0]):
+        return cached[1]
+
+    listings = {}
+    mtimes = {}
+
+    def listdir(path):
+        if path not in listings:
+            try:
+                mtimes[path] = io_call('metadata', os.stat, path).st_mtime_ns
+                with io_call('metadata', os.scandir, path) as it:
+                    listings[path] = {e.name: e.is_dir() for e in it}
+            except OSError:
+                listings[path] = None
+        return listings[path]
+
+    detection = _match_engine(folder, listdir)
+    if detection is None:
+        # Cerca un solo livello sotto (/NOME_GIOCO/QUALCOSA/...)
+        for name, is_dir in sorted((listdir(folder) or {}).items()):
+            if is_dir:
+                detection = _match_engine(os.path.join(folder, name), listdir)
+                if detection is not None:
+                    break
+    with _detection_lock:
+        _detection_cache[folder] = (mtimes, detection)
+    return detection
+
+
+def invalidate_detection(folder):
+    """Scarta l'esito in cache per folder (da chiamare dopo aver modificato l'albero)."""
+    with _detection_lock:
+        _detection_cache.pop(folder, None)
+
+
+def is_renpy_game(folder):
+    # Riconosce sia /game/saves che /QUALCOSA/game/saves (un solo livello)
+    detection = detect_game(folder)
+    return detection is not None and detection.engine == 'RenPy'
+
+
+def is_rpgm_game(folder):
+    detection = detect_game(folder)
+    return detection is not None and detection.engine.startswith('RPGM')
+
+
+def find_save_dir(folder):
+    """Ritorna il path della cartella dei salvataggi (anche annidata di un livello) o None."""
+    detection = detect_game(folder)
+    return detection.save_dir if detection is not None else None
+
+
+def keep_checker(folder, detection):
+    """Ritorna una funzione (path, is_dir) -> bool che indica se il path sopravvive alla pulizia:
+    la cartella dei salvataggi (o i soli file save_files al suo interno) e le sue cartelle padre.
+    """
+    save_dir = detection.save_dir
+    save_prefix = save_dir + os.sep
+    ancestors = set()
+    parent = save_dir
+    while len(parent) >= len(folder):
+        ancestors.add(parent)
+        parent = os.path.dirname(parent)
+
+    def is_kept(path, is_dir):
+        if path in ancestors:
+            return True
+        if not path.startswith(save_prefix):
+            return False
+        if detection.save_files is None:
+            return True
+        return (not is_dir and os.path.dirname(path) == save_dir
+                and fnmatch.fnmatchcase(os.path.basename(path), detection.save_files))
+
+    return is_kept
+
+
+FLATTEN_TMP_PREFIX = '.gfc-flatten-'
+
+
+def _flatten_op_done(op):
+    """True se la rinomina op (src, dst, inode) risulta già eseguita: dst esiste ed è lo stesso inode di src.
+    Le voci di journal precedenti senza inode ricadono sul controllo di esistenza.
+    """
+    src, dst = op[0], op[1]
+    try:
+        dst_st = os.lstat(dst)
+    except OSError:
+        return False
+    if len(op) > 2 and op[2] is not None:
+        return dst_st.st_ino == op[2]
+    return not os.path.lexists(src)
+
+
+def _run_flatten_ops(folder, nested, ops):
+    """Esegue (o riprende) le rinomine del journal; in caso di collisione annulla quelle già fatte.
+    Idempotente: se tutte le destinazioni finali sono già al loro posto non rinomina nulla
+    e rimuove solo la cartella temporanea (o annidata) rimasta vuota.
+    Ritorna True se il flatten è stato completato.
+    """
+    uses_tmp = bool(ops) and ops[0][0] == nested and os.path.basename(ops[0][1]).startswith(FLATTEN_TMP_PREFIX)
+    final_ops = ops[1:] if uses_tmp else ops
+    leftover = ops[0][1] if uses_tmp else nested
+    if not all(_flatten_op_done(op) for op in final_ops):
+        done = []
+        for op in ops:
+            src, dst = op[0], op[1]
+            if _flatten_op_done(op):
+                done.append((src, dst))  # già eseguita prima dell'interruzione
+                continue
+            try:
+                if os.path.lexists(dst):
+                    raise FileExistsError(errno.EEXIST, 'destinazione già esistente', dst)
+                io_call('metadata', os.rename, src, dst)
+                done.append((src, dst))
+            except OSError as e:
+                logging.error(f'Flatten di {folder} fallito su {src} -> {dst}: {e}. Annullo le rinomine già fatte')
+                for done_src, done_dst in reversed(done):
+                    try:
+                        io_call('metadata', os.rename, done_dst, done_src)
+                    except OSError as rollback_error:
+                        logging.error(f'Rollback flatten fallito su {done_dst} -> {done_src}: {rollback_error}')
+                return False
+    try:
+        os.rmdir(leftover)
+        logging.info(f'Rimossa cartella annidata: {leftover}')
+    except FileNotFoundError:
+        pass  # già rimossa prima dell'interruzione
+    except OSError as e:
+        logging.warning(f'Cartella annidata {leftover} non rimossa (non vuota?): {e}')
+    return True
+
+
+def _clear_flatten_journal(folder):
+    conn = _get_ledger(folder_root(folder))
+    with _ledger_lock:
+        conn.execute('DELETE FROM flatten_journal WHERE folder = ?', (folder,))
+        conn.commit()
+
+
+def flattened_detection(folder, detection):
+    """GameDetection di folder dopo il flatten: root e cartella dei salvataggi portate su di un livello."""
+    if detection is None or detection.root == folder:
+        return detection
+    save_dir = os.path.normpath(os.path.join(folder, os.path.relpath(detection.save_dir, detection.root)))
+    return detection._replace(root=folder, save_dir=save_dir)
+
+
+def flatten_folder(folder, detection=None):
+    # Se la struttura è /NOME_GIOCO/QUALCOSA/game/saves (o equivalente per gli altri motori), porta su di un livello
+    # solo ciò che resta dopo la pulizia (la gerarchia dei salvataggi) con os.rename atomiche.
+    # detection è il riconoscimento fatto prima della pulizia: dopo l'eliminazione i marcatori di alcuni motori
+    # (es. js/rmmz_core.js, Game.ini) non esistono più e un nuovo detect_game non troverebbe la cartella annidata.
+    # Le rinomine vengono registrate in un journal nel ledger, così un'interruzione può essere ripresa o annullata.
+    # Ritorna True se la cartella è piatta (flatten completato o non necessario), False se annullato o fallito
+    if detection is None:
+        detection = detect_game(folder)
+    if detection is None or detection.root == folder:
+        return True
+    nested = detection.root
+    if not os.path.isdir(nested) and os.path.isdir(flattened_detection(folder, detection).save_dir):
+        return True  # già portata su in un tentativo precedente
+    try:
+        names = sorted(io_call('metadata', os.listdir, nested))
+        source_dir = nested
+        ops = []
+        if os.path.basename(nested) in names:
+            # Es. /NOME/game/game/saves: la cartella annidata va prima spostata su un nome temporaneo
+            source_dir = os.path.join(folder, FLATTEN_TMP_PREFIX + os.path.basename(nested))
+            ops.append((nested, source_dir, os.lstat(nested).st_ino))
+        # Ogni rinomina porta l'inode da spostare, così la ripresa riconosce quelle già eseguite
+        ops.extend((os.path.join(source_dir, name), os.path.join(folder, name), os.lstat(os.path.join(nested, name)).st_ino)
+                   for name in names)
+        # Collisioni rilevate prima di toccare qualsiasi cosa
+        collisions = [dst for src, dst, _ in ops if os.path.lexists(dst) and dst != nested]
+        if collisions:
+            logging.error(f'Flatten di {folder} annullato: destinazioni già esistenti {collisions[:3]}')
+            return False
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            conn.execute(
+                'INSERT OR REPLACE INTO flatten_journal (folder, nested, ops, created) VALUES (?, ?, ?, ?)',
+                (folder, nested, json.dumps(ops), datetime.now().isoformat())
+            )
+            conn.commit()
+        flattened = _run_flatten_ops(folder, nested, ops)
+        _clear_flatten_journal(folder)
+    except Exception as e:
+        logging.warning(f'Errore in flatten_folder per {folder}: {e}')
+        flattened = False
+    invalidate_detection(folder)
+    return flattened
+
+
+def recover_flatten_journals(root=None):
+    """Riprende (o annulla, in caso di collisioni) i flatten di root rimasti a metà per un'interruzione."""
+    try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            rows = conn.execute('SELECT folder, nested, ops FROM flatten_journal').fetchall()
+    except Exception as e:
+        logging.error(f'Errore lettura journal flatten: {e}')
+        return
+    for folder, nested, ops_json in rows:
+        logging.warning(f'Trovato flatten interrotto per {folder}: ripresa')
+        ops = [tuple(op) for op in json.loads(ops_json)]
+        if _run_flatten_ops(folder, nested, ops):
+            logging.info(f'Flatten di {folder} completato dopo la ripresa')
+        else:
+            telegram_force_notify(f'❌ Flatten interrotto di {os.path.basename(folder)} annullato: verificare manualmente')
+        _clear_flatten_journal(folder)
+        invalidate_detection(folder)
+
+
+def _fix_permissions_batch(parent, entries, uid, gid, mode, stats):
+    """Corregge owner/permessi delle entries di una stessa directory, solo dove differiscono.
+    Usa chiamate relative a dir_fd senza seguire i symlink.
+    """
+    changed = 0
+    skipped = 0
+    failed = []
+    try:
+        dir_fd = _open_dir(parent) if _DIR_FD_SUPPORTED else None
+    except OSError as err:
+        metric_errno('open', err)
+        with stats['lock']:
+            stats['failed'].extend(e.path for e in entries)
+        return
+    try:
+        for entry in entries:
+            name = os.path.basename(entry.path) if dir_fd is not None else entry.path
+            need_chown = entry.uid != uid or entry.gid != gid
+            # chmod sui symlink non ha senso su Linux (e fchmodat non supporta AT_SYMLINK_NOFOLLOW)
+            need_chmod = not stat.S_ISLNK(entry.mode) and stat.S_IMODE(entry.mode) != mode
+            if not need_chown and not need_chmod:
+                skipped += 1
+                continue
+            op = 'chown'
+            try:
+                if need_chown:
+                    io_call('metadata', os.chown, name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+                op = 'chmod'
+                if need_chmod:
+                    io_call('metadata', os.chmod, name, mode, dir_fd=dir_fd)
+                changed += 1
+            except OSError as e:
+                metric_errno(op, e)
+                failed.append(entry.path)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    with stats['lock']:
+        stats['changed'] += changed
+        stats['skipped'] += skipped
+        stats['failed'].extend(failed)
+
+
+def fix_permissions(folder, snapshot, uid, gid, mode=0o777, only_paths=None, workers=None):
+    """Motore permessi: usa i dati di stat dello snapshot e modifica solo gli inode diversi da uid/gid/mode.
+    Le directory vengono lavorate a lotti in parallelo su un pool di thread.
+    only_paths, se indicato, limita il lavoro a quei path.
+    Ritorna un dict con i conteggi 'changed', 'skipped' e la lista 'failed' (senza duplicati).
+    """
+    batches = {}
+    for entry in snapshot:
+        if only_paths is not None and entry.path not in only_paths:
+            continue
+        batches.setdefault(os.path.dirname(entry.path), []).append(entry)
+    stats = {'lock': threading.Lock(), 'changed': 0, 'skipped': 0, 'failed': []}
+    with ThreadPoolExecutor(max_workers=max(1, workers or PERMISSION_WORKERS), thread_name_prefix='perms') as pool:
+        for future in [pool.submit(_fix_permissions_batch, parent, entries, uid, gid, mode, stats)
+                       for parent, entries in batches.items()]:
+            future.result()
+    del stats['lock']
+    return stats
+
+
+def _survivor_paths(folder, snapshot):
+    """Path che sopravviveranno alla pulizia: cartella dei salvataggi, suo contenuto e cartelle padre."""
+    detection = detect_game(folder)
+    if detection is None:
+        return None
+    is_kept = keep_checker(folder, detection)
+    return {e.path for e in snapshot if is_kept(e.path, e.is_dir)}
+
+
+def set_permissions(folder, snapshot=None):
+    """Cerca di impostare ownership (uid/gid corrente) e chmod 777 ricorsivamente su folder.
+    Usa lo snapshot passato (o ne crea uno) e tocca solo gli oggetti non già corretti.
+    Con PERMISSIONS_SCOPE=survivors sistema solo i salvataggi e le loro cartelle padre.
+    Se fallisce invia una notifica Telegram e ritorna False; altrimenti True.
+    """
+    try:
+        try:
+            uid = os.getuid()
+            gid = os.getgid()
+        except AttributeError:
+            # In ambienti senza getuid (molto raro), fallback a root
+            uid = 0
+            gid = 0
+
+        if snapshot is None:
+            snapshot = scan_tree(folder)
+        only_paths = _survivor_paths(folder, snapshot) if PERMISSIONS_SCOPE == 'survivors' else None
+        stats = fix_permissions(folder, snapshot, uid, gid, only_paths=only_paths)
+        failed = stats['failed']
+
+        if failed:
+            # manda notifica di fallimento con alcuni esempi
+            sample = failed[:5]
+            msg = f'❌ Fallita impostazione permessi per {os.path.basename(folder)}: permessi mancanti su {len(failed)} oggetti. Esempi: {sample}'
+            logging.error(msg)
+            try:
+                telegram_force_notify(msg)
+            except Exception:
+                logging.debug('Invio notifica Telegram fallito durante set_permissions (fail)')
+            return False
+
+        # tutto ok
+        msg = (f'✅ Permessi impostati correttamente per {os.path.basename(folder)}: '
+               f'{stats["changed"]} oggetti modificati, {stats["skipped"]} già corretti')
+        logging.info(msg)
+        try:
+            telegram_force_notify(msg)
+        except Exception:
+            logging.debug('Invio notifica Telegram fallito durante set_permissions (success)')
+        return True
+    except Exception as e:
+        logging.error(f'Errore critico impostazione permessi per {folder}: {e}')
+        try:
+            telegram_force_notify(f'❌ Fallita impostazione permessi per {folder}: {e}')
+        except Exception:
+            logging.debug('Invio notifica Telegram fallito durante set_permissions (except)')
+        return False
+
+
+_ledger_lock = threading.RLock()
+_ledger_connections = {}
+
+
+def _migrate_csv_log(conn, root):
+    """Importa nel ledger le righe di un folders_log.csv preesistente (una sola volta per root)."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'csv_migrated'").fetchone():
+        return
+    log_file = os.path.join(root, CSV_LOG_FILENAME)
+    imported = 0
+    if os.path.isfile(log_file):
+        with open(log_file, 'r', newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                try:
+                    space_saved = float(row['space_saved_MB']) if row.get('space_saved_MB') else None
+                except ValueError:
+                    space_saved = None
+                conn.execute(
+                    'INSERT INTO actions (timestamp, folder, action, result, space_saved_mb) VALUES (?, ?, ?, ?, ?)',
+                    (row.get('timestamp'), row.get('folder'), row.get('action'), row.get('result'), space_saved)
+                )
+                imported += 1
+        logging.info(f'Migrate {imported} righe da {log_file} nel ledger {LEDGER_FILENAME}')
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_migrated', ?)", (datetime.now().isoformat(),))
+
+
+def _normalize_ledger_paths(conn):
+    """Normalizza (una sola volta per ledger) i percorsi scritti quando FOLDER_WATCHED non veniva normalizzato
+    (es. '/data//Gioco' con FOLDER_WATCHED='/data/'), così folder_root() li riconduce alla radice giusta.
+    Se il percorso normalizzato esiste già, la riga con il percorso vecchio viene scartata.
+    """
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'paths_normalized'").fetchone():
+        return
+    fixed = 0
+    for table, column in (('actions', 'folder'), ('flatten_journal', 'folder'), ('folder_jobs', 'folder'),
+                          ('folder_fingerprints', 'folder'), ('save_hashes', 'path')):
+        for (path,) in conn.execute(f'SELECT DISTINCT {column} FROM {table}').fetchall():
+            if not path or os.path.normpath(path) == path:
+                continue
+            conn.execute(f'UPDATE OR IGNORE {table} SET {column} = ? WHERE {column} = ?', (os.path.normpath(path), path))
+            conn.execute(f'DELETE FROM {table} WHERE {column} = ?', (path,))
+            fixed += 1
+    if fixed:
+        logging.info(f'Normalizzati {fixed} percorsi nel ledger {LEDGER_FILENAME}')
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('paths_normalized', ?)", (datetime.now().isoformat(),))
+
+
+def _add_missing_columns(conn, table, columns):
+    # Colonne aggiunte dopo la creazione del ledger: le tabelle esistenti vengono estese con ALTER TABLE
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for name, kind in columns:
+        if name not in existing:
+            try:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {kind}')
+            except sqlite3.OperationalError:
+                pass  # aggiunta nel frattempo da un altro processo
+
+
+def _get_ledger(root=None):
+    """Restituisce la connessione al ledger SQLite di root (default la prima radice di FOLDER_WATCHED).
+    La connessione viene aperta una sola volta e riutilizzata; al primo avvio migra il CSV esistente
+    e normalizza i percorsi delle righe già presenti.
+    """
+    root = os.path.normpath(root) if root else watched_roots()[0]
+    with _ledger_lock:
+        conn = _ledger_connections.get(root)
+        if conn is not None:
+            return conn
+        os.makedirs(root, exist_ok=True)
+        db_path = os.path.join(root, LEDGER_FILENAME)
+        is_new = not os.path.isfile(db_path)
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS actions ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, folder TEXT, '
+            'action TEXT, result TEXT, space_saved_mb REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_actions_folder ON actions (folder)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_actions_result ON actions (result)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS flatten_journal ('
+            'folder TEXT PRIMARY KEY, nested TEXT, ops TEXT, created TEXT)'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS folder_jobs ('
+            'folder TEXT PRIMARY KEY, state TEXT, game_type TEXT, '
+            'deleted_bytes INTEGER DEFAULT 0, deleted_inodes INTEGER DEFAULT 0, updated TEXT, detection TEXT)'
+        )
+        _add_missing_columns(conn, 'folder_jobs', [('detection', 'TEXT')])
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS folder_fingerprints ('
+            'folder TEXT PRIMARY KEY, ino INTEGER, mtime_ns INTEGER, child_mtime_ns INTEGER, '
+            'entries INTEGER, size INTEGER, outcome TEXT, failures INTEGER DEFAULT 0, '
+            'next_retry REAL, updated TEXT, ctime_ns INTEGER, child_ctime_ns INTEGER)'
+        )
+        _add_missing_columns(conn, 'folder_fingerprints', [('ctime_ns', 'INTEGER'), ('child_ctime_ns', 'INTEGER')])
+        # Cache degli hash dei salvataggi: digest NULL = file registrato ma non ancora letto (nessun altro della stessa dimensione)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS save_hashes ('
+            'path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_save_hashes_inode ON save_hashes (dev, ino, size, mtime_ns)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_save_hashes_size ON save_hashes (dev, size, digest)')
+        # Stime dello spazio recuperabile per SCHEDULE_POLICY=largest, valide finché inode e mtime della cartella non cambiano
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS folder_estimates ('
+            'folder TEXT PRIMARY KEY, ino INTEGER, mtime_ns INTEGER, reclaimable INTEGER, updated TEXT)'
+        )
+        conn.commit()
+        # Migrazioni una tantum in un'unica transazione con il lock di scrittura preso subito: più pod
+        # (shard) che aprono insieme lo stesso ledger non importano due volte il CSV
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            _migrate_csv_log(conn, root)
+            _normalize_ledger_paths(conn)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        if is_new:
+            try:
+                os.chmod(db_path, 0o777)
+            except Exception as e:
+                logging.warning(f'Impossibile impostare permessi 777 su {db_path}: {e}')
+        _ledger_connections[root] = conn
+        return conn
+
+
+CSV_HEADER = ['timestamp', 'folder', 'action', 'result', 'space_saved_MB']
+_csv_exports = {}  # root -> (file, writer) dell'export CSV aperto
+
+
+def _format_csv_row(timestamp, folder, action, result, space_saved):
+    return [timestamp, folder, action, result, f"{space_saved:.2f}" if space_saved is not None else '']
+
+
+def _ensure_log_permissions(log_file):
+    # Permessi 777 impostati una sola volta (all'apertura), non dopo ogni riga
+    try:
+        if stat.S_IMODE(os.stat(log_file).st_mode) != 0o777:
+            os.chmod(log_file, 0o777)
+    except Exception as e:
+        logging.warning(f'Impossibile impostare permessi 777 su {log_file}: {e}')
+
+
+def _csv_writer(root=None):
+    """Ritorna (file, writer) dell'export CSV di root, aprendo il file una sola volta per scan."""
+    root = os.path.normpath(root) if root else watched_roots()[0]
+    export = _csv_exports.get(root)
+    if export is None:
+        log_file = os.path.join(root, csv_log_filename())
+        file_exists = os.path.isfile(log_file)
+        csvfile = open(log_file, 'a', newline='')
+        writer = csv.writer(csvfile)
+        if not file_exists:
+            writer.writerow(CSV_HEADER)
+        _ensure_log_permissions(log_file)
+        export = _csv_exports[root] = (csvfile, writer)
+    return export
+
+
+def close_folder_log(root=None):
+    """Chiude (e scarica su disco) l'export CSV aperto durante lo scan."""
+    with _ledger_lock:
+        export = _csv_exports.pop(os.path.normpath(root) if root else watched_roots()[0], None)
+        if export is not None:
+            try:
+                export[0].close()
+            except Exception as e:
+                logging.error(f'Errore chiusura export CSV: {e}')
+
+
+def close_folder_logs():
+    """Chiude gli export CSV di tutte le radici (all'uscita, anche dopo un SIGTERM)."""
+    for root in list(_csv_exports):
+        close_folder_log(root)
+
+
+atexit.register(close_folder_logs)
+
+
+def compact_ledger(root=None):
+    """Compatta il ledger: una sola riga per cartella e azione (la più recente) con lo spazio risparmiato
+    cumulativo, così i totali non cambiano e l'esito della pulizia resta accanto a quello della deduplicazione.
+    Ritorna il numero di righe rimosse.
+    """
+    conn = _get_ledger(root)
+    with _ledger_lock:
+        before = conn.execute('SELECT COUNT(*) FROM actions').fetchone()[0]
+        conn.execute('DROP TABLE IF EXISTS temp.compacted')
+        conn.execute(
+            'CREATE TEMP TABLE compacted AS '
+            'SELECT MAX(id) AS id, SUM(space_saved_mb) AS total FROM actions GROUP BY folder, action'
+        )
+        conn.execute('DELETE FROM actions WHERE id NOT IN (SELECT id FROM temp.compacted)')
+        conn.execute('UPDATE actions SET space_saved_mb = (SELECT total FROM temp.compacted c WHERE c.id = actions.id)')
+        conn.execute('DROP TABLE temp.compacted')
+        conn.commit()
+        after = conn.execute('SELECT COUNT(*) FROM actions').fetchone()[0]
+    if before != after:
+        logging.info(f'Ledger compattato: {before} -> {after} righe')
+    return before - after
+
+
+def rotate_folder_log(root=None):
+    """Archivia l'export CSV corrente (folders_log.<timestamp>.csv, tenendo gli ultimi CSV_ROTATE_KEEP)
+    e inizia un nuovo segmento con lo stato compattato: ultima riga per cartella e azione con totali cumulativi.
+    Con lo sharding ogni pod ruota il proprio file, che riparte dalle sole cartelle del suo shard.
+    """
+    root = root or watched_roots()[0]
+    filename = csv_log_filename()
+    log_file = os.path.join(root, filename)
+    close_folder_log(root)
+    base, ext = os.path.splitext(filename)
+    if os.path.isfile(log_file):
+        os.rename(log_file, os.path.join(root, f'{base}.{datetime.now().strftime("%Y%m%d-%H%M%S")}{ext}'))
+    segment = re.compile(re.escape(base) + r'\.\d{8}-\d{6}' + re.escape(ext))
+    archived = sorted(n for n in os.listdir(root) if segment.fullmatch(n))
+    for old in archived[:max(0, len(archived) - CSV_ROTATE_KEEP)]:
+        os.remove(os.path.join(root, old))
+    conn = _get_ledger(root)
+    with _ledger_lock:
+        rows = conn.execute(
+            'SELECT a.timestamp, a.folder, a.action, a.result, t.total FROM actions a '
+            'JOIN (SELECT MAX(id) AS id, SUM(space_saved_mb) AS total FROM actions GROUP BY folder, action) t ON a.id = t.id '
+            'ORDER BY a.id'
+        ).fetchall()
+        rows = [row for row in rows if in_shard(row[1])]
+        tmp = log_file + '.tmp'
+        with open(tmp, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(_format_csv_row(*row) for row in rows)
+        os.replace(tmp, log_file)
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                     (_csv_segment_key(), datetime.now().isoformat()))
+        conn.commit()
+    _ensure_log_permissions(log_file)
+    logging.info(f'Export CSV ruotato: nuovo segmento con {len(rows)} righe compattate')
+
+
+def maintain_folder_log(root=None):
+    """Manutenzione a inizio scan: compatta il ledger se cresciuto troppo e ruota l'export CSV
+    se supera CSV_ROTATE_BYTES o è più vecchio di CSV_ROTATE_DAYS giorni.
+    Con più pod sulla stessa radice il ledger condiviso lo compatta solo lo shard 0; ogni shard ruota il proprio CSV.
+    """
+    root = root or watched_roots()[0]
+    try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            rows = conn.execute('SELECT COUNT(*) FROM actions').fetchone()[0]
+            groups = conn.execute('SELECT COUNT(*) FROM (SELECT 1 FROM actions GROUP BY folder, action)').fetchone()[0]
+            started = conn.execute('SELECT value FROM meta WHERE key = ?', (_csv_segment_key(),)).fetchone()
+        if SHARD_SPEC[0] == 0 and groups and rows > LOG_COMPACT_RATIO * groups:
+            compact_ledger(root)
+        if not CSV_EXPORT_ENABLED:
+            return
+        log_file = os.path.join(root, csv_log_filename())
+        if started is None:
+            with _ledger_lock:
+                conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                             (_csv_segment_key(), datetime.now().isoformat()))
+                conn.commit()
+        too_big = CSV_ROTATE_BYTES and os.path.isfile(log_file) and os.path.getsize(log_file) > CSV_ROTATE_BYTES
+        too_old = (CSV_ROTATE_DAYS and started is not None and
+                   (datetime.now() - datetime.fromisoformat(started[0])).days >= CSV_ROTATE_DAYS)
+        if too_big or too_old:
+            rotate_folder_log(root)
+    except Exception as e:
+        logging.error(f'Errore manutenzione log cartelle: {e}')
+
+
+def log_folder_action(folder, action, result, space_saved=None):
+    timestamp = datetime.now().isoformat()
+    try:
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            conn.execute(
+                'INSERT INTO actions (timestamp, folder, action, result, space_saved_mb) VALUES (?, ?, ?, ?, ?)',
+                (timestamp, folder, action, result, space_saved)
+            )
+            conn.commit()
+    except Exception as e:
+        logging.error(f'Impossibile scrivere log azione per {folder}: {e}')
+    if CSV_EXPORT_ENABLED:
+        try:
+            with _ledger_lock:
+                csvfile, writer = _csv_writer(folder_root(folder))
+                writer.writerow(_format_csv_row(timestamp, folder, action, result, space_saved))
+                # Una write per riga sull'handle già aperto: un pod terminato non perde righe già nel ledger
+                csvfile.flush()
+        except Exception as e:
+            logging.error(f'Impossibile esportare log CSV per {folder}: {e}')
+
+
+def get_total_space_saved(root=None):
+    try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            row = conn.execute('SELECT COALESCE(SUM(space_saved_mb), 0) FROM actions').fetchone()
+        return float(row[0])
+    except Exception as e:
+        logging.error(f'Errore lettura log totale spazio: {e}')
+    return 0.0
+
+
+def get_unrecognized_folders(root=None):
+    """Elenca (senza duplicati) le cartelle di root registrate come tipo di gioco non riconosciuto."""
+    try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            rows = conn.execute(
+                'SELECT folder FROM actions WHERE result = ? GROUP BY folder ORDER BY MIN(id)',
+                ('Tipo di gioco non riconosciuto',)
+            ).fetchall()
+        return [r[0] for r in rows]
+    except Exception as e:
+        logging.error(f'Errore lettura giochi non riconosciuti: {e}')
+    return []
+
+
+# Stati del journal di lavoro per cartella, in ordine di avanzamento
+JOB_STATES = ['planned', 'permissions-done', 'deleting', 'flattened', 'done']
+# Stati da cui una cartella può essere ripresa senza ripetere l'attesa di stabilità
+JOB_RESUMABLE_STATES = {'permissions-done', 'deleting', 'flattened'}
+# Ogni quanti secondi salvare il cursore di avanzamento durante l'eliminazione
+JOB_CURSOR_INTERVAL = 10
+
+
+def get_folder_job(folder):
+    """Ritorna lo stato del journal di lavoro di folder come dict, o None se non c'è.
+    La chiave 'detection' contiene la GameDetection salvata prima della pulizia (o None).
+    """
+    try:
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            row = conn.execute(
+                'SELECT state, game_type, deleted_bytes, deleted_inodes, updated, detection FROM folder_jobs WHERE folder = ?',
+                (folder,)
+            ).fetchone()
+    except Exception as e:
+        logging.error(f'Errore lettura journal di lavoro per {folder}: {e}')
+        return None
+    if row is None:
+        return None
+    job = dict(zip(['state', 'game_type', 'deleted_bytes', 'deleted_inodes', 'updated', 'detection'], row))
+    if job['detection']:
+        job['detection'] = GameDetection(*json.loads(job['detection']))
+    return job
+
+
+def set_folder_job(folder, state, **fields):
+    """Registra lo stato (e gli eventuali campi game_type, deleted_bytes, deleted_inodes, detection) del lavoro su folder."""
+    fields = dict(fields, state=state, updated=datetime.now().isoformat())
+    if fields.get('detection') is not None:
+        fields['detection'] = json.dumps(fields['detection'])
+    columns = list(fields)
+    try:
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            conn.execute(
+                f'INSERT INTO folder_jobs (folder, {", ".join(columns)}) VALUES (?{", ?" * len(columns)}) '
+                f'ON CONFLICT(folder) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in columns)}',
+                (folder, *fields.values())
+            )
+            conn.commit()
+    except Exception as e:
+        logging.error(f'Impossibile aggiornare journal di lavoro per {folder}: {e}')
+
+
+def clear_folder_job(folder):
+    """Rimuove il journal di lavoro di folder (es. fallimento prima di qualsiasi modifica)."""
+    try:
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            conn.execute('DELETE FROM folder_jobs WHERE folder = ?', (folder,))
+            conn.commit()
+    except Exception as e:
+        logging.error(f'Impossibile rimuovere il journal di lavoro per {folder}: {e}')
+
+
+def get_stuck_jobs(root=None):
+    """Cartelle di root rimaste in uno stato intermedio del journal: lista di (folder, state, updated)."""
     try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            return conn.execute(
+                "SELECT folder, state, updated FROM folder_jobs WHERE state != 'done' ORDER BY folder"
+            ).fetchall()
+    except Exception as e:
+        logging.error(f'Errore lettura journal di lavoro: {e}')
+    return []
+
+
+def _fingerprint_level1(folder):
+    """Primo livello dell'impronta: (inode, mtime_ns, ctime_ns) della cartella, una sola stat.
+    Il ctime cambia anche con chmod/chown, così una cartella con i permessi corretti a mano viene ritentata.
+    """
+    st = os.stat(folder)
+    return st.st_ino, st.st_mtime_ns, st.st_ctime_ns
+
+
+def _fingerprint_level2(folder):
+    """Secondo livello dell'impronta: (numero di voci, dimensione, mtime_ns massimo, ctime_ns massimo)
+    delle voci di primo livello. L'mtime delle sottocartelle cambia anche per file aggiunti o rimossi
+    un livello più in basso, il ctime anche per permessi e proprietario.
+    """
+    entries = size = child_mtime = child_ctime = 0
+    with io_call('metadata', os.scandir, folder) as it:
+        for entry in it:
+            st = io_call('metadata', entry.stat, follow_symlinks=False)
+            entries += 1
+            size += st.st_size
+            child_mtime = max(child_mtime, st.st_mtime_ns)
+            child_ctime = max(child_ctime, st.st_ctime_ns)
+    return entries, size, child_mtime, child_ctime
+
+
+def get_folder_fingerprints(root=None):
+    """Impronte salvate delle cartelle fallite di root: dict folder -> dict, lette con una sola query."""
+    columns = ['ino', 'mtime_ns', 'ctime_ns', 'child_mtime_ns', 'child_ctime_ns', 'entries', 'size',
+               'outcome', 'failures', 'next_retry']
+    try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            rows = conn.execute(f'SELECT folder, {", ".join(columns)} FROM folder_fingerprints').fetchall()
+        return {row[0]: dict(zip(columns, row[1:])) for row in rows}
+    except Exception as e:
+        logging.error(f'Errore lettura impronte cartelle: {e}')
+    return {}
+
+
+def folder_unchanged(folder, fingerprint):
+    """True se folder non è cambiata rispetto all'impronta salvata.
+    Il secondo livello (scandir del primo livello) viene calcolato solo se inode, mtime e ctime coincidono.
+    """
+    try:
+        if _fingerprint_level1(folder) != (fingerprint['ino'], fingerprint['mtime_ns'], fingerprint['ctime_ns']):
+            return False
+        return _fingerprint_level2(folder) == (fingerprint['entries'], fingerprint['size'],
+                                               fingerprint['child_mtime_ns'], fingerprint['child_ctime_ns'])
+    except OSError:
+        return False
+
+
+def should_skip_folder(folder, fingerprint, now=None):
+    """True se folder è fallita in passato, non è cambiata e il backoff non è ancora scaduto."""
+    if fingerprint is None:
+        return False
+    if (now or time.time()) >= (fingerprint['next_retry'] or 0):
+        return False
+    return folder_unchanged(folder, fingerprint)
+
+
+def record_folder_failure(folder, outcome):
+    """Salva l'impronta di folder dopo un fallimento (outcome: 'permission_failed', 'flatten_failed' o 'deferred')
+    e programma il prossimo tentativo con backoff esponenziale; il contatore riparte se la cartella era cambiata.
+    """
+    try:
+        ino, mtime, ctime = _fingerprint_level1(folder)
+        entries, size, child_mtime, child_ctime = _fingerprint_level2(folder)
+    except OSError as e:
+        logging.warning(f'Impossibile calcolare l\'impronta di {folder}: {e}')
+        return
+    previous = get_folder_fingerprints(folder_root(folder)).get(folder)
+    unchanged = previous is not None and (
+        (previous['ino'], previous['mtime_ns'], previous['ctime_ns'], previous['entries'], previous['size'],
+         previous['child_mtime_ns'], previous['child_ctime_ns'])
+        == (ino, mtime, ctime, entries, size, child_mtime, child_ctime)
+    )
+    failures = (previous['failures'] or 0) + 1 if unchanged else 1
+    backoff = min(RETRY_BACKOFF_BASE * 2 ** (failures - 1), RETRY_BACKOFF_MAX)
+    try:
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            conn.execute(
+                'INSERT OR REPLACE INTO folder_fingerprints '
+                '(folder, ino, mtime_ns, ctime_ns, child_mtime_ns, child_ctime_ns, entries, size, outcome, failures, '
+                'next_retry, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (folder, ino, mtime, ctime, child_mtime, child_ctime, entries, size, outcome, failures,
+                 time.time() + backoff, datetime.now().isoformat())
+            )
+            conn.commit()
+        logging.info(f'Cartella {folder} fallita ({outcome}, tentativo {failures}): '
+                     f'se non cambia verrà ritentata tra {backoff / 3600:.1f} ore')
+    except Exception as e:
+        logging.error(f'Impossibile salvare l\'impronta di {folder}: {e}')
+
+
+def clear_folder_fingerprint(folder):
+    """Dimentica l'impronta di folder (chiamata quando la cartella viene lavorata)."""
+    try:
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            conn.execute('DELETE FROM folder_fingerprints WHERE folder = ?', (folder,))
+            conn.execute('DELETE FROM folder_estimates WHERE folder = ?', (folder,))
+            conn.commit()
+    except Exception as e:
+        logging.error(f'Impossibile rimuovere l\'impronta di {folder}: {e}')
+
+
+def get_processed_folders(root=None):
+    """Insieme delle cartelle di root già registrate nel ledger, letto con una sola query per ciclo."""
+    try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            return {row[0] for row in conn.execute('SELECT DISTINCT folder FROM actions')}
+    except Exception as e:
+        logging.error(f'Errore lettura ledger: {e}')
+    return set()
+
+
+def get_folder_size(folder):
+    return snapshot_size(iter_tree(folder))
+
+
+def is_folder_already_processed(folder):
+    try:
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            row = conn.execute('SELECT 1 FROM actions WHERE folder = ? LIMIT 1', (folder,)).fetchone()
+        return row is not None
+    except Exception as e:
+        logging.error(f'Errore lettura ledger per {folder}: {e}')
+    return False
+
+
+_DIR_FD_SUPPORTED = os.unlink in os.supports_dir_fd and os.rmdir in os.supports_dir_fd
+
+
+def prune_delete_plan(folder, dirs, files):
+    """Riduce il piano di eliminazione all'insieme minimo:
+    solo le directory non contenute in altre directory da eliminare e i file fuori da esse.
+    """
+    dir_set = set(dirs)
+
+    def covered(path):
+        parent = os.path.dirname(path)
+        while parent != folder and len(parent) > len(folder):
+            if parent in dir_set:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    top_dirs = [d for d in dirs if not covered(d)]
+    top_files = [f for f in files if not covered(f)]
+    return top_dirs, top_files
+
+
+class _DeleteProgress:
+    """Contatori aggregati (thread-safe) del motore di eliminazione."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.errors = {}  # errno -> conteggio
+        self.failed = []  # (path, errno)
+
+    def fail(self, path, err, op):
+        code = getattr(err, 'errno', None)
+        metric_errno(op, err)
+        with self.lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+            self.failed.append((path, code))
+
+
+def _open_dir(path):
+    return io_call('metadata', os.open, path, os.O_RDONLY | os.O_DIRECTORY | getattr(os, 'O_NOFOLLOW', 0))
+
+
+def _unlink_batch(parent, names, sizes, progress):
+    """Elimina i file names (relativi a parent) aprendo la directory una sola volta."""
+    done = 0
+    freed = 0
+    try:
+        dir_fd = _open_dir(parent) if _DIR_FD_SUPPORTED else None
+    except OSError as e:
+        for name in names:
+            progress.fail(os.path.join(parent, name), e, 'open')
+        return
+    try:
+        for name, size in zip(names, sizes):
+            try:
+                if dir_fd is not None:
+                    io_call('unlink', os.unlink, name, dir_fd=dir_fd)
+                else:
+                    io_call('unlink', os.unlink, os.path.join(parent, name))
+                done += 1
+                freed += size
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                progress.fail(os.path.join(parent, name), e, 'unlink')
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    with progress.lock:
+        progress.files += done
+        progress.bytes += freed
+
+
+def _remove_tree(path):
+    """Come shutil.rmtree, ma ogni rimozione passa dal governor I/O: i path in ordine inverso
+    mettono il contenuto prima della propria cartella. I symlink non vengono seguiti.
+    """
+    for entry in sorted(iter_tree(path), reverse=True):
+        io_call('unlink', os.rmdir if entry.is_dir else os.unlink, entry.path)
+
+
+def _rmdir_batch(parent, names, progress):
+    """Rimuove le directory (già svuotate) names relative a parent."""
+    done = 0
+    try:
+        dir_fd = _open_dir(parent) if _DIR_FD_SUPPORTED else None
+    except OSError as e:
+        for name in names:
+            progress.fail(os.path.join(parent, name), e, 'open')
+        return
+    try:
+        for name in names:
+            path = os.path.join(parent, name)
+            try:
+                if dir_fd is not None:
+                    io_call('unlink', os.rmdir, name, dir_fd=dir_fd)
+                else:
+                    io_call('unlink', os.rmdir, path)
+                done += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                if e.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                    # Contenuto comparso dopo lo snapshot: ripiego su rmtree
+                    try:
+                        _remove_tree(path)
+                        done += 1
+                        continue
+                    except OSError as rmtree_error:
+                        e = rmtree_error
+                progress.fail(path, e, 'rmdir')
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    with progress.lock:
+        progress.dirs += done
+
+
+def delete_tree_items(folder, snapshot, top_dirs, top_files, workers=None, on_progress=None):
+    """Motore di eliminazione concorrente.
+    Espande tramite lo snapshot le directory da eliminare, elimina i file a lotti per directory
+    con os.unlink relativo a dir_fd su un pool di thread, poi rimuove le directory dalla più profonda.
+    Il progresso viene riportato come contatori aggregati (e passato a on_progress ogni JOB_CURSOR_INTERVAL
+    secondi, per salvare il cursore nel journal). Ritorna un _DeleteProgress.
+    """
+    workers = workers or DELETE_WORKERS
+    top_dir_set = set(top_dirs)
+    file_batches = {}
+    dirs_by_depth = {}
+
+    def doomed(path):
+        parent = path
+        while len(parent) > len(folder):
+            if parent in top_dir_set:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    for entry in snapshot:
+        if entry.path == folder or not doomed(entry.path):
+            continue
+        parent, name = os.path.split(entry.path)
+        if entry.is_dir:
+            dirs_by_depth.setdefault(entry.path.count(os.sep), {}).setdefault(parent, []).append(name)
+        else:
+            batch = file_batches.setdefault(parent, ([], []))
+            batch[0].append(name)
+            batch[1].append(entry.size)
+    sizes = {e.path: e.size for e in snapshot if not e.is_dir}
+    for path in top_files:
+        parent, name = os.path.split(path)
+        batch = file_batches.setdefault(parent, ([], []))
+        batch[0].append(name)
+        batch[1].append(sizes.get(path, 0))
+
+    progress = _DeleteProgress()
+    total_files = sum(len(names) for names, _ in file_batches.values())
+    total_dirs = sum(len(names) for level in dirs_by_depth.values() for names in level.values())
+    last_log = last_tg = last_cursor = time.time()
+
+    def report(phase):
+        nonlocal last_log, last_tg, last_cursor
+        now = time.time()
+        if on_progress is not None and now - last_cursor >= JOB_CURSOR_INTERVAL:
+            on_progress(progress)
+            last_cursor = now
+        if now - last_log >= 30:
+            logging.info(f"[clean_game_folder] {phase}: {progress.files}/{total_files} file, "
+                         f"{progress.dirs}/{total_dirs} cartelle, {progress.bytes / (1024*1024):.2f} MB liberati in {folder}")
+            last_log = now
+        if now - last_tg >= 300:
+            telegram_notify_guarded(f'🗑️ {phase}: {progress.files}/{total_files} file, {progress.dirs}/{total_dirs} cartelle in {folder}')
+            last_tg = now
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='delete') as pool:
+        futures = [pool.submit(_unlink_batch, parent, names, batch_sizes, progress)
+                   for parent, (names, batch_sizes) in file_batches.items()]
+        for _ in as_completed(futures):
+            report('Eliminazione file')
+        # Le directory vanno rimosse dalla più profonda: ogni livello attende il precedente
+        for depth in sorted(dirs_by_depth, reverse=True):
+            futures = [pool.submit(_rmdir_batch, parent, names, progress)
+                       for parent, names in dirs_by_depth[depth].items()]
+            for _ in as_completed(futures):
+                report('Eliminazione cartelle')
+    return progress
+
+
+def clean_game_folder(folder, snapshot=None):
+    """Elimina tutto tranne i salvataggi e porta su di un livello le strutture annidate.
+    Ritorna False se la cartella resta a metà lavoro (flatten non riuscito o errore), True altrimenti.
+    """
+    root = folder_root(folder)
+    try:
+        # Journal: riconoscimento e byte/oggetti già eliminati da un'esecuzione precedente interrotta
+        job = get_folder_job(folder) or {}
+        with stage_timer('detect', root):
+            # Una cartella ripresa usa il riconoscimento fatto prima della pulizia: i marcatori potrebbero essere già stati eliminati
+            detection = job.get('detection') or detect_game(folder)
+        if detection is None:
+            metric_inc('gfc_folders_total', outcome='unrecognised', game_type='', root=root)
+            logging.warning(f"Tipo di gioco non riconosciuto per la cartella: {folder}")
+            telegram_force_notify(f'❌ Tipo di gioco non riconosciuto in {folder}')
+            log_folder_action(folder, 'clean', 'Tipo di gioco non riconosciuto')
+            set_folder_job(folder, 'done')
+            return True
+        game_type = detection.engine
+        # nome gioco per messaggi
+        game_name = os.path.basename(folder)
+        base_bytes = job.get('deleted_bytes') or 0
+        base_inodes = job.get('deleted_inodes') or 0
+        deleted_bytes = base_bytes
+        if job.get('state') == 'flattened':
+            logging.info(f'[clean_game_folder] {folder}: eliminazione e flatten già completati, registro solo l\'esito')
+        else:
+            if base_bytes or base_inodes:
+                logging.info(f'[clean_game_folder] Ripresa pulizia di {folder}: già eliminati {base_inodes} oggetti')
+            set_folder_job(folder, 'deleting', game_type=game_type, detection=detection)
+            with stage_timer('walk', root):
+                # Snapshot unico dell'albero: piano di eliminazione e spazio liberato
+                if snapshot is None:
+                    snapshot = scan_tree(folder)
+                # Elimina tutto tranne la cartella dei salvataggi e la sua gerarchia
+                is_kept = keep_checker(folder, detection)
+                to_delete_dirs = []
+                to_delete_files = []
+                for entry in snapshot:
+                    if entry.path == folder or is_kept(entry.path, entry.is_dir):
+                        continue
+                    if entry.is_dir:
+                        to_delete_dirs.append(entry.path)
+                    else:
+                        to_delete_files.append(entry.path)
+
+                top_dirs, top_files = prune_delete_plan(folder, to_delete_dirs, to_delete_files)
+            logging.info(f"[clean_game_folder] Da eliminare: {len(top_dirs)} cartelle e {len(top_files)} file di primo livello "
+                         f"({len(to_delete_dirs)} cartelle, {len(to_delete_files)} file in totale) in {folder}")
+
+            def save_cursor(progress):
+                set_folder_job(folder, 'deleting', deleted_bytes=base_bytes + progress.bytes,
+                               deleted_inodes=base_inodes + progress.files + progress.dirs)
+
+            with stage_timer('delete', root):
+                progress = delete_tree_items(folder, snapshot, top_dirs, top_files, on_progress=save_cursor)
+            invalidate_detection(folder)
+            metric_inc('gfc_deleted_bytes_total', progress.bytes, root=root)
+            metric_inc('gfc_deleted_inodes_total', progress.files + progress.dirs, root=root)
+            save_cursor(progress)
+            deleted_bytes = base_bytes + progress.bytes
+            logging.info(f"[clean_game_folder] Eliminati {progress.files} file e {progress.dirs} cartelle "
+                         f"({progress.bytes / (1024*1024):.2f} MB) in {folder}")
+            if progress.errors:
+                logging.error(f"[clean_game_folder] Errori di eliminazione per errno in {folder}: "
+                              f"{ {errno.errorcode.get(code, code): count for code, count in progress.errors.items()} }")
+            failed_paths = [path for path, code in progress.failed if code in (errno.EACCES, errno.EPERM)]
+            # Se ci sono errori di permessi, notifica e non segnare la cartella come pulita
+            if failed_paths:
+                sample = failed_paths[:3]
+                telegram_force_notify(f'❌ Impossibile completare pulizia di {game_name}: permessi insufficienti su {len(failed_paths)} oggetti. Esempi: {sample}')
+                log_folder_action(folder, 'clean', f'Fallita per permessi in {game_type}', None)
+                set_folder_job(folder, 'done')
+                metric_inc('gfc_folders_total', outcome='delete_permission_failed', game_type=game_type, root=root)
+                return True
+
+            # Struttura annidata: ora restano solo i salvataggi, che vengono portati su di un livello
+            with stage_timer('flatten', root):
+                flattened = flatten_folder(folder, detection)
+            if not flattened:
+                # Il journal resta in 'deleting': al prossimo tentativo l'eliminazione non trova nulla e il flatten viene ripetuto
+                telegram_force_notify(f'❌ Flatten di {game_name} non riuscito: salvataggi rimasti in {detection.root}, '
+                                      f'verrà ritentato (dettagli nel log)')
+                record_folder_failure(folder, 'flatten_failed')
+                metric_inc('gfc_folders_total', outcome='flatten_failed', game_type=game_type, root=root)
+                return False
+            set_folder_job(folder, 'flattened')
+
+        # Spazio liberato ricavato dallo snapshot: somma dei file effettivamente eliminati (anche in esecuzioni precedenti)
+        space_saved = deleted_bytes / (1024 * 1024)  # MB
+        total_saved = get_total_space_saved(root) + space_saved
+
+        telegram_force_notify(
+            f'🧹 Pulito gioco {game_name}\n'
+            f'✅ Pulizia completata per {game_type}\n'
+            f'Spazio risparmiato in questa cartella: {space_saved:.2f} MB\n'
+            f'Totale risparmiato: {total_saved:.2f} MB'
+        )
+        log_folder_action(folder, 'clean', f'Pulizia completata per {game_type}', space_saved)
+        set_folder_job(folder, 'done')
+        metric_inc('gfc_folders_total', outcome='cleaned', game_type=game_type, root=root)
+        if DEDUP_SAVES != 'off':
+            with stage_timer('dedup', root):
+                dedup_saves(folder, detection=flattened_detection(folder, detection))
+        return True
+    except Exception as e:
+        logging.error(f'Errore in clean_game_folder({folder}): {e}')
+        return False
+
+
+DEDUP_MODES = ('hardlink', 'reflink')
+DEDUP_TMP_PREFIX = '.gfc-dedup-'
+DEDUP_CHUNK_SIZE = 1024 * 1024
+# Righe della cache degli hash scritte al massimo in una transazione, per non tenere a lungo il lock di scrittura del ledger
+DEDUP_COMMIT_ROWS = 200
+FICLONE = 0x40049409  # ioctl di linux/fs.h: reflink dell'intero file (btrfs, XFS, bcachefs)
+
+
+def _file_digest(path):
+    """SHA-256 di path letto a blocchi (memoria costante)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DEDUP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _commit_save_hashes(conn):
+    # Chiude la transazione aperta dalle scritture nella cache prima di leggere file (il lock del ledger
+    # è condiviso con gli altri worker e con gli altri pod)
+    with _ledger_lock:
+        if conn.in_transaction:
+            conn.commit()
+
+
+def _cached_digest(conn, path, st):
+    """Digest di path dalla cache (stesso inode, dimensione e mtime), altrimenti letto dal file."""
+    with _ledger_lock:
+        row = conn.execute(
+            'SELECT digest FROM save_hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? '
+            'AND digest IS NOT NULL LIMIT 1',
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        ).fetchone()
+    if row:
+        return row[0]
+    _commit_save_hashes(conn)
+    return _file_digest(path)
+
+
+def _record_save_hash(conn, path, st, digest):
+    with _ledger_lock:
+        conn.execute(
+            'INSERT OR REPLACE INTO save_hashes (path, dev, ino, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?, ?)',
+            (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest)
+        )
+
+
+def _find_duplicate(conn, path, st, digest):
+    """Cerca nella cache un altro inode dello stesso filesystem con contenuto identico a path.
+    Le righe non più valide vengono rimosse, quelle mai lette (digest NULL) vengono calcolate ora.
+    """
+    with _ledger_lock:
+        rows = conn.execute(
+            'SELECT path, ino, mtime_ns, digest FROM save_hashes '
+            'WHERE dev = ? AND size = ? AND (digest = ? OR digest IS NULL) AND ino != ? ORDER BY digest IS NULL',
+            (st.st_dev, st.st_size, digest, st.st_ino)
+        ).fetchall()
+    for other, ino, mtime_ns, other_digest in rows:
+        try:
+            other_st = os.stat(other, follow_symlinks=False)
+        except OSError:
+            other_st = None
+        if other_st is None or (other_st.st_ino, other_st.st_size, other_st.st_mtime_ns) != (ino, st.st_size, mtime_ns):
+            with _ledger_lock:
+                conn.execute('DELETE FROM save_hashes WHERE path = ?', (other,))
+            continue
+        if other_digest is None:
+            _commit_save_hashes(conn)
+            other_digest = _file_digest(other)
+            _record_save_hash(conn, other, other_st, other_digest)
+        # Confronto byte per byte prima di sostituire: l'hash da solo seleziona i candidati
+        if other_digest == digest:
+            _commit_save_hashes(conn)
+        if other_digest == digest and filecmp.cmp(other, path, shallow=False):
+            return other
+    return None
+
+
+def _link_duplicate(source, target, mode):
+    """Sostituisce target con un hardlink o un reflink di source: il nuovo file viene creato con un nome
+    temporaneo nella stessa cartella e poi portato al posto di target con os.replace (atomica).
+    """
+    tmp = os.path.join(os.path.dirname(target), DEDUP_TMP_PREFIX + os.path.basename(target))
+    try:
+        if mode == 'hardlink':
+            os.link(source, tmp)
+        else:
+            with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(target, tmp)
+        io_call('unlink', os.replace, tmp, target)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def dedup_saves(folder, mode=None, detection=None):
+    """Sostituisce i salvataggi di folder identici a quelli di altre cartelle della stessa radice
+    (es. versioni diverse dello stesso gioco) con hardlink o reflink (mode, default DEDUP_SAVES).
+    I file vengono raggruppati prima per dimensione e letti solo se hanno un possibile gemello;
+    gli hash restano in cache nel ledger per (inode, dimensione, mtime). Ritorna i byte recuperati.
+    detection è il riconoscimento fatto prima della pulizia (portato su dal flatten), perché dopo
+    l'eliminazione i marcatori di alcuni motori non esistono più.
+    """
+    mode = mode or DEDUP_SAVES
+    if mode not in DEDUP_MODES:
+        logging.warning(f"DEDUP_SAVES '{mode}' non valido: usare 'off', 'hardlink' o 'reflink'")
+        return 0
+    if detection is None:
+        detection = detect_game(folder)
+    if detection is None or not os.path.isdir(detection.save_dir):
+        return 0
+    files = [entry for entry in iter_tree(detection.save_dir)
+             if stat.S_ISREG(entry.mode) and entry.size > 0
+             and not os.path.basename(entry.path).startswith(DEDUP_TMP_PREFIX)]
+    if not files:
+        return 0
+    conn = _get_ledger(folder_root(folder))
+    dev = os.stat(detection.save_dir).st_dev
+    prefix = folder + os.sep
+    with _ledger_lock:
+        # Dimensioni dei salvataggi già registrati per le altre cartelle: i possibili gemelli
+        known_sizes = {size for (size,) in conn.execute(
+            'SELECT DISTINCT size FROM save_hashes WHERE dev = ? AND substr(path, 1, ?) != ?', (dev, len(prefix), prefix))}
+    local_sizes = {}
+    for entry in files:
+        local_sizes[entry.size] = local_sizes.get(entry.size, 0) + 1
+    linked = 0
+    reclaimed = 0
+    try:
+        for idx, entry in enumerate(files, 1):
+            path = entry.path
+            if idx % DEDUP_COMMIT_ROWS == 0:
+                _commit_save_hashes(conn)
+            try:
+                st = os.stat(path, follow_symlinks=False)
+                if local_sizes[st.st_size] < 2 and st.st_size not in known_sizes:
+                    # Nessun gemello possibile: registrato senza leggerlo
+                    _record_save_hash(conn, path, st, None)
+                    continue
+                digest = _cached_digest(conn, path, st)
+                source = _find_duplicate(conn, path, st, digest)
+                if source is not None:
+                    _link_duplicate(source, path, mode)
+                    linked += 1
+                    if st.st_nlink == 1 or mode == 'reflink':
+                        reclaimed += st.st_size
+                    st = os.stat(path, follow_symlinks=False)
+                _record_save_hash(conn, path, st, digest)
+            except OSError as e:
+                metric_errno('dedup', e)
+                if mode == 'reflink' and e.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.EXDEV):
+                    logging.warning(f'[dedup_saves] Reflink non supportato dal filesystem di {folder}: {e}')
+                    break
+                logging.warning(f'[dedup_saves] Impossibile deduplicare {path}: {e}')
+    finally:
+        _commit_save_hashes(conn)
+    if linked:
+        space_saved = reclaimed / (1024 * 1024)
+        metric_inc('gfc_dedup_bytes_total', reclaimed, root=folder_root(folder))
+        logging.info(f'[dedup_saves] {linked} salvataggi sostituiti con {mode} in {folder} ({space_saved:.2f} MB)')
+        telegram_force_notify(f'🔗 Deduplicati {linked} salvataggi di {os.path.basename(folder)}: {space_saved:.2f} MB recuperati')
+        log_folder_action(folder, 'dedup', f'Deduplicati {linked} salvataggi ({mode})', space_saved)
+    return reclaimed
+
+
+def process_folder(folder, snapshot=None):
+    """Permessi, pulizia e flatten di una cartella già stabile.
+    Le fasi già completate secondo il journal di lavoro vengono saltate.
+    Ritorna True se la cartella è stata lavorata, False se saltata.
+    """
+    if snapshot is None:
+        snapshot = scan_tree(folder)
+    job = get_folder_job(folder)
+    if job is None or job['state'] not in JOB_RESUMABLE_STATES:
+        set_folder_job(folder, 'planned', deleted_bytes=0, deleted_inodes=0)
+        # Prova a impostare ownership/permessi prima di partire
+        with stage_timer('permissions', folder_root(folder)):
+            perms_ok = set_permissions(folder, snapshot)
+        if not perms_ok:
+            metric_inc('gfc_folders_total', outcome='permission_failed', game_type='', root=folder_root(folder))
+            logging.warning(f"Saltata cartella per fallimento impostazione permessi: {folder}")
+            record_folder_failure(folder, 'permission_failed')
+            # Nulla è stato eliminato: la cartella non è a metà lavoro, verrà ripresa da capo
+            clear_folder_job(folder)
+            # set_permissions invia già una notifica Telegram in caso di errore
+            return False
+        set_folder_job(folder, 'permissions-done')
+    # La pulizia avviene prima del flatten: si spostano solo i salvataggi, non gli asset da eliminare
+    if not clean_game_folder(folder, snapshot):
+        return False
+    clear_folder_fingerprint(folder)
+    return True
+
+
+def stable_snapshot(folder, max_wait=None):
+    """Snapshot di una cartella pronta: le cartelle interrotte a metà lavoro (già stabili in passato)
+    vengono riprese subito, le altre passano da wait_for_stable_folder. None se non ancora stabile.
+    Con max_wait (attesa accorciata dal budget del ciclo) un timeout non viene registrato come fallimento.
+    """
+    job = get_folder_job(folder)
+    if job is not None and job['state'] in JOB_RESUMABLE_STATES:
+        logging.info(f"Ripresa cartella {folder} dallo stato '{job['state']}'")
+        with stage_timer('walk', folder_root(folder)):
+            return scan_tree(folder)
+    with stage_timer('stability', folder_root(folder)):
+        snapshot = wait_for_stable_folder(folder, max_wait=max_wait)
+    if snapshot is None:
+        metric_inc('gfc_folders_total', outcome='deferred', game_type='', root=folder_root(folder))
+        if max_wait is None:
+            record_folder_failure(folder, 'deferred')
+    return snapshot
+
+
+def disk_usage_percent(path=None):
+    """Percentuale occupata del volume che contiene path (default la prima radice di FOLDER_WATCHED)."""
+    usage = shutil.disk_usage(path or watched_roots()[0])
+    return 100.0 * usage.used / usage.total if usage.total else 0.0
+
+
+def _folder_mtime(folder):
+    try:
+        return os.stat(folder).st_mtime
+    except OSError:
+        return float('inf')
+
+
+def get_folder_estimates(root=None):
+    """Stime salvate dello spazio recuperabile delle cartelle di root: dict folder -> (ino, mtime_ns, byte)."""
+    try:
+        conn = _get_ledger(root)
+        with _ledger_lock:
+            rows = conn.execute('SELECT folder, ino, mtime_ns, reclaimable FROM folder_estimates').fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+    except Exception as e:
+        logging.error(f'Errore lettura stime cartelle: {e}')
+    return {}
+
+
+def _folder_reclaimable(folder, cached=None):
+    """Byte recuperabili stimati per folder: dalla stima salvata se inode e mtime della cartella non sono cambiati
+    (una sola stat), altrimenti con plan_folder, salvando il risultato per i cicli successivi.
+    """
+    try:
+        key = _fingerprint_level1(folder)[:2]  # inode e mtime: il ctime cambia anche solo con i permessi
+        if cached is not None and tuple(cached[:2]) == key:
+            return cached[2]
+        reclaimable = plan_folder(folder)['reclaimable_bytes']
+        conn = _get_ledger(folder_root(folder))
+        with _ledger_lock:
+            conn.execute(
+                'INSERT OR REPLACE INTO folder_estimates (folder, ino, mtime_ns, reclaimable, updated) VALUES (?, ?, ?, ?, ?)',
+                (folder, *key, reclaimable, datetime.now().isoformat())
+            )
+            conn.commit()
+        return reclaimable
+    except Exception as e:
+        logging.warning(f'Impossibile stimare lo spazio recuperabile di {folder}: {e}')
+        return 0
+
+
+def schedule_folders(folders, policy=None, estimates=None, budget=None):
+    """Ordina la coda di un ciclo secondo policy (default SCHEDULE_POLICY).
+    'largest' stima lo spazio recuperabile con plan_folder (un giro dei metadati per cartella, riutilizzato
+    nei cicli successivi finché la cartella non cambia) e copia le stime nel dict estimates o in quello di budget;
+    se il budget del ciclo si esaurisce durante le stime, le cartelle non stimate restano in fondo.
+    'oldest' usa l'mtime della cartella; a parità vale l'ordine alfabetico.
+    """
+    policy = policy or SCHEDULE_POLICY
+    folders = sorted(folders)
+    if policy == 'largest':
+        cached = {}
+        for root in {folder_root(folder) for folder in folders}:
+            cached.update(get_folder_estimates(root))
+        reclaimable = {}
+        with stage_timer('schedule', folder_root(folders[0])):
+            for idx, folder in enumerate(folders):
+                reason = budget.exhausted() if budget is not None else None
+                if reason:
+                    logging.info(f'Stima dello spazio recuperabile interrotta ({reason}): '
+                                 f'{len(folders) - idx} cartelle restano in fondo alla coda')
+                    break
+                reclaimable[folder] = _folder_reclaimable(folder, cached.get(folder))
+        if estimates is None and budget is not None:
+            estimates = budget.estimates
+        if estimates is not None:
+            estimates.update(reclaimable)
+        return sorted(folders, key=lambda f: (f not in reclaimable, -reclaimable.get(f, 0)))
+    if policy == 'oldest':
+        return sorted(folders, key=_folder_mtime)
+    if policy != 'name':
+        logging.warning(f"SCHEDULE_POLICY '{policy}' sconosciuta, uso l'ordine alfabetico")
+    return folders
+
+
+class _CycleBudget:
+    """Budget di un ciclo di scan: tempo (CYCLE_TIME_BUDGET) e byte liberati (CYCLE_BYTES_BUDGET).
+    Esaurito il budget non si iniziano altre cartelle; quelle già avviate vengono completate.
+    Con le stime di spazio recuperabile (policy 'largest') una cartella parte solo se rientra nei byte residui.
+    """
+
+    def __init__(self, start, seconds=None, max_bytes=None):
+        self.start = start
+        self.seconds = CYCLE_TIME_BUDGET if seconds is None else seconds
+        self.max_bytes = CYCLE_BYTES_BUDGET if max_bytes is None else max_bytes
+        self.bytes = 0
+        self.estimates = {}  # folder -> byte recuperabili stimati
+        self.reserved = {}  # folder avviate e non ancora concluse -> stima riservata
+        self.lock = threading.Lock()
+
+    def admit(self, folder):
+        """Riserva il budget per folder prima di avviarla: None se può partire, altrimenti il motivo.
+        La prima cartella del ciclo parte comunque, anche se da sola supera il budget di byte.
+        """
+        reason = self.exhausted()
+        if reason:
+            return reason
+        estimate = self.estimates.get(folder, 0)
+        with self.lock:
+            committed = self.bytes + sum(self.reserved.values())
+            if self.max_bytes and estimate and committed and committed + estimate > self.max_bytes:
+                return f'{estimate / (1024 * 1024):.2f} MB stimati oltre il budget di byte residuo'
+            self.reserved[folder] = estimate
+        return None
+
+    def release(self, folder):
+        """Libera la riserva di una cartella rinviata o fallita."""
+        with self.lock:
+            self.reserved.pop(folder, None)
+
+    def add_folder(self, folder):
+        """Somma i byte liberati su folder (dal journal di lavoro) al posto della sua stima."""
+        job = get_folder_job(folder)
+        with self.lock:
+            self.reserved.pop(folder, None)
+            self.bytes += (job or {}).get('deleted_bytes') or 0
+
+    def exhausted(self):
+        """Motivo per cui il budget è esaurito, o None."""
+        if self.seconds and time.monotonic() - self.start >= self.seconds:
+            return f'budget di tempo di {self.seconds:.0f}s esaurito'
+        with self.lock:
+            if self.max_bytes and self.bytes >= self.max_bytes:
+                return f'budget di {self.max_bytes / (1024 * 1024):.0f} MB liberati raggiunto'
+        return None
+
+    def stability_wait(self):
+        """max_wait da passare a stable_snapshot: None se il budget di tempo non accorcia STABLE_MAX_WAIT."""
+        if not self.seconds:
+            return None
+        remaining = max(self.seconds - (time.monotonic() - self.start), STABLE_CHECK_INTERVAL)
+        if STABLE_MAX_WAIT and remaining >= STABLE_MAX_WAIT:
+            return None
+        return remaining
+
+
+def _process_folder_collected(folder, snapshot, budget=None):
+    if budget is not None:
+        reason = budget.exhausted()
+        if reason:
+            logging.info(f'Cartella {folder} rinviata al prossimo ciclo: {reason}')
+            budget.release(folder)
+            return False
+    with collect_notifications():
+        worked = process_folder(folder, snapshot)
+    if budget is not None:
+        if worked:
+            budget.add_folder(folder)
+        else:
+            budget.release(folder)
+    return worked
+
+
+def _scan_pipelined(candidates, workers, budget=None):
+    """Osserva la stabilità delle cartelle candidate in parallelo e passa quelle pronte
+    a un pool di workers thread per permessi, flatten e pulizia.
+    Le attese di stabilità partono nell'ordine di candidates, al massimo STABILITY_WATCHERS alla volta,
+    solo per le cartelle che rientrano nel budget residuo e solo finché le cartelle stabili in coda sono meno
+    dei worker: ognuna tiene in memoria il proprio snapshot, che altrimenti crescerebbe con l'intera libreria. Quando un worker è libero riceve, tra le cartelle
+    già stabili, la prima secondo l'ordine di candidates: le cartelle ancora in copia non bloccano le altre.
+    Ritorna la lista delle cartelle lavorate.
+    """
+    processed = []
+    rank = {folder: i for i, folder in enumerate(candidates)}
+    waiting = list(reversed(candidates))  # da avviare: pop() restituisce la prossima in ordine
+    ready = []  # heap di (rango, cartella, snapshot) delle cartelle stabili in attesa di un worker
+    stability = {}
+    processing = {}
+    deferred = 0
+    max_watchers = max(1, min(len(candidates), STABILITY_WATCHERS))
+    watchers = ThreadPoolExecutor(max_workers=max_watchers, thread_name_prefix='stability')
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker')
+    try:
+        while waiting or stability or ready or processing:
+            while waiting and len(stability) < max_watchers and len(ready) < workers:
+                folder = waiting.pop()
+                reason = budget.admit(folder) if budget is not None else None
+                if reason:
+                    logging.info(f'Cartella {folder} rinviata al prossimo ciclo: {reason}')
+                    deferred += 1
+                    continue
+                max_wait = budget.stability_wait() if budget is not None else None
+                stability[watchers.submit(stable_snapshot, folder, max_wait)] = folder
+            while ready and len(processing) < workers:
+                _, folder, snapshot = heapq.heappop(ready)
+                processing[pool.submit(_process_folder_collected, folder, snapshot, budget)] = folder
+            if not stability and not processing:
+                continue
+            done, _ = wait(list(stability) + list(processing), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in stability:
+                    folder = stability.pop(future)
+                    try:
+                        snapshot = future.result()
+                    except Exception as e:
+                        logging.error(f'Errore attesa stabilità per {folder}: {e}')
+                        snapshot = None
+                    else:
+                        if snapshot is None:
+                            telegram_force_notify(f'⏳ Cartella {folder} ancora in modifica, rinviata al prossimo ciclo')
+                    if snapshot is None:
+                        if budget is not None:
+                            budget.release(folder)
+                        continue
+                    logging.info(f"Cartella stabile, in coda per la pulizia: {folder}")
+                    heapq.heappush(ready, (rank[folder], folder, snapshot))
+                else:
+                    folder = processing.pop(future)
+                    try:
+                        if future.result():
+                            processed.append(folder)
+                    except Exception as e:
+                        logging.error(f'Errore elaborazione {folder}: {e}')
+    finally:
+        watchers.shutdown(wait=True)
+        pool.shutdown(wait=True)
+    if deferred:
+        telegram_force_notify(f'⏱️ {deferred} cartelle rinviate al prossimo ciclo per il budget')
+    return processed
+
+
+def scan_and_process_folders(entries=None, root=None):
+    """Lavora le nuove cartelle di root o, se non indicata, di tutte le radici di FOLDER_WATCHED
+    (in parallelo, fino a ROOT_WORKERS alla volta).
+    Se entries è indicato (nomi di primo livello, es. da --watch) controlla solo quelle invece di listare tutto.
+    """
+    roots = [root] if root else watched_roots()
+    if len(roots) == 1:
+        scan_root(roots[0], entries)
+    else:
+        with ThreadPoolExecutor(max_workers=ROOT_WORKERS or len(roots), thread_name_prefix='root') as pool:
+            for future in [pool.submit(scan_root, r, entries) for r in roots]:
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f'Errore scan radice: {e}')
+    export_metrics()
+
+
+def scan_root(root, entries=None):
+    """Un ciclo di scan su una radice, con ledger, budget e statistiche propri.
+    Con lo sharding attivo vengono considerate solo le cartelle dello shard di questo processo.
+    Il riepilogo di fine ciclo (totali, giochi non riconosciuti, cartelle a metà) viene inviato solo
+    negli scan completi, non in quelli mirati di --watch che partono a ogni gruppo di eventi.
+    """
+    scan_start = time.monotonic()
+    full_scan = entries is None
+    if full_scan:
+        telegram_force_notify(f'🔄 Inizio scan cartelle in {root}')
+    else:
+        logging.info(f'Scan mirato di {len(entries)} cartelle in {root}')
+    if not os.path.isdir(root):
+        logging.warning(f"La cartella da monitorare non esiste: {root}")
+        return
+    if SCHEDULE_DISK_THRESHOLD:
+        used = disk_usage_percent(root)
+        metric_set('gfc_disk_usage_ratio', used / 100, root=root)
+        if used < SCHEDULE_DISK_THRESHOLD:
+            telegram_force_notify(f'💤 Volume di {root} occupato al {used:.1f}%, '
+                                  f'sotto la soglia del {SCHEDULE_DISK_THRESHOLD:.0f}%: nessuna pulizia in questo ciclo')
+            return
+    budget = _CycleBudget(scan_start)
+    recover_flatten_journals(root)
+    maintain_folder_log(root)
+    nuove_cartelle = []
+    candidates = []
+    # Un solo scandir (tipo dalla voce, senza stat) e una sola query per le cartelle già lavorate e le impronte
+    if entries is None:
+        with os.scandir(root) as it:
+            listing = sorted((entry.name, entry.is_dir()) for entry in it)
+    else:
+        listing = sorted((entry, os.path.isdir(os.path.join(root, entry))) for entry in entries)
+    entries = [name for name, _ in listing]
+    processed = get_processed_folders(root)
+    fingerprints = get_folder_fingerprints(root)
+    skipped = 0
+    for idx, (entry, is_dir) in enumerate(listing):
+        folder = os.path.join(root, entry)
+        if is_dir and folder not in processed and in_shard(folder):
+            if should_skip_folder(folder, fingerprints.get(folder)):
+                logging.debug(f'Cartella {folder} invariata dall\'ultimo fallimento, saltata')
+                metric_inc('gfc_folders_total', outcome='unchanged', game_type='', root=root)
+                skipped += 1
+                continue
+            logging.info(f"Nuova cartella trovata: {folder}")
+            candidates.append(folder)
+        else:
+            # Notifica periodica se la scansione è lunga e non ci sono nuove cartelle
+            telegram_notify_guarded(f'🔎 Scansione in corso in {root}... ({idx+1}/{len(entries)})')
+    if len(candidates) > 1:
+        candidates = schedule_folders(candidates, budget=budget)
+    if WORKERS > 1:
+        if candidates:
+            telegram_force_notify(f'📁 {len(candidates)} nuove cartelle da processare con {WORKERS} worker')
+            nuove_cartelle.extend(_scan_pipelined(candidates, WORKERS, budget))
+    else:
+        for idx, folder in enumerate(candidates):
+            reason = budget.exhausted()
+            if reason:
+                telegram_force_notify(f'⏱️ {reason}: {len(candidates) - idx} cartelle rinviate al prossimo ciclo')
+                break
+            reason = budget.admit(folder)
+            if reason:
+                logging.info(f'Cartella {folder} rinviata al prossimo ciclo: {reason}')
+                continue
+            telegram_notify_guarded(f'📁 Sto per processare la cartella: {folder} ({idx+1}/{len(candidates)})')
+            snapshot = stable_snapshot(folder, budget.stability_wait())
+            if snapshot is None:
+                telegram_force_notify(f'⏳ Cartella {folder} ancora in modifica, rinviata al prossimo ciclo')
+                budget.release(folder)
+                continue
+            if process_folder(folder, snapshot):
+                nuove_cartelle.append(folder)
+                budget.add_folder(folder)
+            else:
+                budget.release(folder)
+    if skipped:
+        logging.info(f'{skipped} cartelle fallite in precedenza e invariate saltate fino alla scadenza del backoff')
+    if full_scan:
+        total_saved = get_total_space_saved(root)
+        telegram_force_notify(
+            f'✅ Fine ciclo pulizia in {root}. Cartelle lavorate: {len(nuove_cartelle)}\n'
+            f'Totale spazio risparmiato: {total_saved:.2f} MB'
+        )
+
+        # Dopo la fine ciclo, elenca giochi non riconosciuti
+        non_riconosciuti = [f for f in get_unrecognized_folders(root) if in_shard(f)]
+        if non_riconosciuti:
+            msg = '⚠️ Giochi non riconosciuti da risolvere manualmente:\n' + '\n'.join(non_riconosciuti)
+            telegram_force_notify(msg)
+
+        # Cartelle rimaste a metà (interruzioni, permessi): verranno riprese al prossimo ciclo
+        stuck = [job for job in get_stuck_jobs(root) if in_shard(job[0])]
+        if stuck:
+            msg = '⚠️ Cartelle in uno stato intermedio:\n' + '\n'.join(f'{folder} ({state}, {updated})' for folder, state, updated in stuck)
+            telegram_force_notify(msg)
+    else:
+        logging.info(f'Fine scan mirato in {root}. Cartelle lavorate: {len(nuove_cartelle)}')
+
+    close_folder_log(root)
+    scan_duration = time.monotonic() - scan_start
+    metric_observe('gfc_scan_duration_seconds', scan_duration, root=root)
+    metric_set('gfc_last_scan_duration_seconds', scan_duration, root=root)
+
+
+PLAN_FIELDS = ['folder', 'status', 'game_type', 'total_bytes', 'total_inodes', 'reclaimable_bytes',
+               'delete_files', 'delete_dirs', 'kept_bytes', 'kept_inodes', 'scan_seconds', 'estimated_seconds']
+
+
+def plan_folder(folder):
+    """Calcola cosa eliminerebbe clean_game_folder su folder senza modificare nulla.
+    Un solo passaggio sui metadati in streaming (memoria costante, nessuno snapshot in RAM).
+    La stima dei tempi usa la latenza per oggetto misurata durante la scansione e DELETE_WORKERS.
+    """
+    detection = detect_game(folder)
+    report = dict.fromkeys(PLAN_FIELDS, 0)
+    report.update(folder=folder, status='recognised' if detection else 'unrecognised',
+                  game_type=detection.engine if detection else '')
+    is_kept = keep_checker(folder, detection) if detection else None
+    start = time.monotonic()
+    for entry in iter_tree(folder):
+        report['total_bytes'] += entry.size
+        report['total_inodes'] += 1
+        if entry.path == folder or is_kept is None or is_kept(entry.path, entry.is_dir):
+            report['kept_bytes'] += entry.size
+            report['kept_inodes'] += 1
+        elif entry.is_dir:
+            report['delete_dirs'] += 1
+        else:
+            report['delete_files'] += 1
+            report['reclaimable_bytes'] += entry.size
+    elapsed = time.monotonic() - start
+    report['scan_seconds'] = round(elapsed, 3)
+    if report['total_inodes']:
+        per_inode = elapsed / report['total_inodes']
+        report['estimated_seconds'] = round(
+            per_inode * (report['delete_files'] + report['delete_dirs']) / max(1, DELETE_WORKERS), 3)
+    return report
+
+
+def _plan_row(folder, ledger_exists, totals, writer, out):
+    if ledger_exists and is_folder_already_processed(folder):
+        report = dict.fromkeys(PLAN_FIELDS, 0)
+        report.update(folder=folder, status='processed', game_type='')
+    else:
+        report = plan_folder(folder)
+    for key in PLAN_FIELDS[3:]:
+        totals[key] += report[key]
+    if writer:
+        writer.writerow(report)
+    else:
+        out.write(json.dumps(report) + '\n')
+    out.flush()
+
+
+def plan_folders(output='-', fmt='json'):
+    """Modalità --plan/--dry-run: scrive un report (JSON Lines o CSV) cartella per cartella, in streaming,
+    con spazio recuperabile, numero di oggetti e cartelle non riconosciute, più una riga di totale finale.
+    """
+    totals = dict.fromkeys(PLAN_FIELDS, 0)
+    totals.update(folder='TOTAL', status='summary', game_type='')
+    out = sys.stdout if output == '-' else open(output, 'w', newline='')
+    try:
+        writer = csv.DictWriter(out, fieldnames=PLAN_FIELDS) if fmt == 'csv' else None
+        if writer:
+            writer.writeheader()
+        for root in watched_roots():
+            # Il ledger viene consultato solo se esiste già: il dry-run non deve creare file nella share
+            ledger_exists = os.path.isfile(os.path.join(root, LEDGER_FILENAME))
+            names = sorted(os.listdir(root)) if os.path.isdir(root) else []
+            for name in names:
+                folder = os.path.join(root, name)
+                if os.path.isdir(folder) and in_shard(folder):
+                    _plan_row(folder, ledger_exists, totals, writer, out)
+        totals['scan_seconds'] = round(totals['scan_seconds'], 3)
+        totals['estimated_seconds'] = round(totals['estimated_seconds'], 3)
+        if writer:
+            writer.writerow(totals)
+        else:
+            out.write(json.dumps(totals) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    logging.info(f"Piano: {totals['reclaimable_bytes'] / (1024*1024):.2f} MB recuperabili, "
+                 f"{totals['delete_files'] + totals['delete_dirs']} oggetti da eliminare, "
+                 f"stima {totals['estimated_seconds']:.0f}s")
+    return totals
+
+
+# Costanti inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_INOTIFY_EVENT = struct.Struct('iIII')
+_INOTIFY_ROOT_MASK = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+_INOTIFY_CHILD_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_MODIFY | IN_MOVE_SELF
+
+
+class _Inotify:
+    """Wrapper minimo su inotify via ctypes: watch sulla root e sulle cartelle di primo livello.
+    Ogni evento viene ricondotto al nome della cartella di primo livello interessata.
+    Non è ricorsivo: le scritture più in profondità (es. Gioco/game/saves/x) non generano eventi,
+    ma la cartella passa comunque da wait_for_stable_folder, che controlla l'intero albero.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 fallita')
+        self.names = {}  # wd -> nome di primo livello ('' per la root)
+        self.wds = {}  # nome di primo livello -> wd
+        self.add_watch('', _INOTIFY_ROOT_MASK)
+
+    def add_watch(self, name, mask=_INOTIFY_CHILD_MASK):
+        if name in self.wds:
+            return
+        path = os.path.join(self.root, name) if name else self.root
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if not name:
+                raise OSError(err, f'inotify_add_watch fallita su {path}')
+            logging.debug(f'inotify_add_watch fallita su {path}: {os.strerror(err)}')
+            return
+        # Una cartella rinominata dentro la root mantiene lo stesso wd: il vecchio nome va scartato
+        self._forget(wd)
+        self.names[wd] = name
+        self.wds[name] = wd
+
+    def _forget(self, wd):
+        name = self.names.pop(wd, None)
+        if name is not None and self.wds.get(name) == wd:
+            del self.wds[name]
+
+    def remove_watch(self, name):
+        wd = self.wds.get(name) if name else None
+        if wd is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            self._forget(wd)
+
+    def read(self, timeout):
+        """Attende fino a timeout secondi; ritorna (nomi di primo livello toccati, overflow)."""
+        touched = set()
+        overflow = False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return touched, overflow
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return touched, overflow
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            raw_name = data[offset + _INOTIFY_EVENT.size:offset + _INOTIFY_EVENT.size + length].split(b'\0', 1)[0]
+            offset += _INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                # Watch rimosso dal kernel (cartella eliminata o smontata) o da remove_watch
+                self._forget(wd)
+                continue
+            top = self.names.get(wd)
+            if top is None:
+                continue
+            if mask & IN_MOVE_SELF:
+                # Cartella spostata: se rinominata nella root il wd è già passato al nuovo nome
+                # (IN_MOVED_TO sulla root arriva prima), altrimenti è uscita dalla root e il watch va tolto
+                if top and not os.path.isdir(os.path.join(self.root, top)):
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                    self._forget(wd)
+                continue
+            if top:
+                touched.add(top)
+            elif raw_name and mask & IN_ISDIR:
+                # Sulla root interessano solo le cartelle (ignora ledger/CSV)
+                name = os.fsdecode(raw_name)
+                touched.add(name)
+                self.add_watch(name)
+        return touched, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_folders(root=None):
+    """Modalità --watch: lavora le cartelle di primo livello create o modificate appena si stabilizzano
+    (WATCH_DEBOUNCE secondi senza eventi), con un rescan completo ogni WATCH_RESCAN_INTERVAL secondi
+    come rete di sicurezza per NFS, dove gli eventi remoti non vengono notificati.
+    Senza root osserva tutte le radici di FOLDER_WATCHED, ognuna nel proprio thread.
+    """
+    if root is None:
+        roots = watched_roots()
+        if len(roots) > 1:
+            threads = [threading.Thread(target=watch_folders, args=(r,), name=f'watch-{os.path.basename(r)}', daemon=True)
+                       for r in roots]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return
+        root = roots[0]
+    rescan_interval = WATCH_RESCAN_INTERVAL or CHECK_INTERVAL
+    try:
+        watcher = _Inotify(root)
+    except (OSError, AttributeError) as e:
+        logging.warning(f'inotify non disponibile ({e}): uso scan periodico ogni {rescan_interval}s')
+        while True:
+            scan_and_process_folders(root=root)
+            time.sleep(rescan_interval)
+    try:
+        # Watch sulle cartelle non ancora lavorate, per accorgersi di copie ancora in corso
+        for entry in os.scandir(root):
+            if entry.is_dir() and in_shard(entry.path) and not is_folder_already_processed(entry.path):
+                watcher.add_watch(entry.name)
+        scan_and_process_folders(root=root)
+        last_rescan = time.monotonic()
+        pending = {}  # nome -> istante dell'ultimo evento
+        while True:
+            now = time.monotonic()
+            next_due = last_rescan + rescan_interval
+            if pending:
+                next_due = min(next_due, min(pending.values()) + WATCH_DEBOUNCE)
+            touched, overflow = watcher.read(max(0.0, next_due - now))
+            now = time.monotonic()
+            for name in touched:
+                pending[name] = now
+            if overflow or now - last_rescan >= rescan_interval:
+                if overflow:
+                    logging.warning('Coda inotify piena: eseguo rescan completo')
+                scan_and_process_folders(root=root)
+                last_rescan = now
+                pending.clear()
+                continue
+            ready = [name for name, last_event in pending.items() if now - last_event >= WATCH_DEBOUNCE]
+            for name in ready:
+                del pending[name]
+            # Gli eventi generati dalla nostra stessa pulizia riguardano cartelle già lavorate
+            to_scan = [name for name in ready if not is_folder_already_processed(os.path.join(root, name))]
+            if to_scan:
+                scan_and_process_folders(to_scan, root)
+            for name in ready:
+                if is_folder_already_processed(os.path.join(root, name)):
+                    watcher.remove_watch(name)
+    finally:
+        watcher.close()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Game Folder Cleaner')
+    p.add_argument('--once', action='store_true', help='Esegui una sola scansione e termina')
+    p.add_argument('--folder', action='append', help='Cartella radice da monitorare, ripetibile (sovrascrive FOLDER_WATCHED)')
+    p.add_argument('--shard', type=str, help="Lavora solo lo shard i/N delle cartelle (hash del nome), es. --shard 0/3")
+    p.add_argument('--check-interval', type=int, help='Sovrascrive CHECK_INTERVAL in secondi')
+    p.add_argument('--watch', action='store_true', help='Resta in ascolto degli eventi inotify invece di fare polling ogni CHECK_INTERVAL')
+    p.add_argument('--workers', type=int, help='Numero di cartelle lavorate in parallelo (sovrascrive WORKERS)')
+    p.add_argument('--schedule', choices=SCHEDULE_POLICIES, help='Ordine della coda di un ciclo (sovrascrive SCHEDULE_POLICY)')
+    p.add_argument('--plan', '--dry-run', dest='plan', action='store_true',
+                   help='Non modifica nulla: calcola spazio recuperabile e oggetti da eliminare per ogni cartella')
+    p.add_argument('--plan-format', choices=['json', 'csv'], default='json', help='Formato del report di --plan (default json)')
+    p.add_argument('--plan-output', default='-', help='File del report di --plan (default stdout)')
+    p.add_argument('--debug', action='store_true', help='Abilita log di debug')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    global FOLDER_WATCHED, CHECK_INTERVAL, WORKERS, SCHEDULE_POLICY, SHARD_SPEC
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if args.folder:
+        FOLDER_WATCHED = args.folder
+    if args.shard:
+        SHARD_SPEC = parse_shard(args.shard)
+    if args.check_interval:
+        CHECK_INTERVAL = args.check_interval
+    if args.workers:
+        WORKERS = args.workers
+    if args.schedule:
+        SCHEDULE_POLICY = args.schedule
+
+    # Prima di qualsiasi thread (ereditano la priorità) e anche per la scansione di --plan
+    set_io_priority()
+
+    if args.plan:
+        plan_folders(args.plan_output, args.plan_format)
+        return
+
+    if METRICS_PORT:
+        start_metrics_server()
+
+    # Se in container, esegui una sola scansione di default (comportamento CronJob)
+    run_once = args.once or os.getenv('CONTAINER_MODE', '').lower() == 'true'
+
+    roots = ', '.join(watched_roots())
+    shard = f' (shard {SHARD_SPEC[0]}/{SHARD_SPEC[1]})' if SHARD_SPEC[1] > 1 else ''
+    logging.info(f'In ascolto su {roots}{shard}... (v{APP_VERSION})')
+    telegram_force_notify(f'🚀 Game Folder Cleaner v{APP_VERSION} avviato e in ascolto su {roots}{shard}')
+
+    try:
+        if args.watch:
+            watch_folders()
+            return
         if run_once:
             scan_and_process_folders()
             logging.info('Scansione completata. Uscita.')
@@ -516,6 +3030,9 @@ def main():
             time.sleep(CHECK_INTERVAL)
     except KeyboardInterrupt:
         logging.info('Interrotto da tastiera.')
+    finally:
+        close_folder_logs()
+        flush_telegram()
 
 
 if __name__ == '__main__':